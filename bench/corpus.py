@@ -0,0 +1,157 @@
+"""
+Synthetic uss-helpdesk corpus for the fake RT server.
+Tickets are dictionaries of RT properties, with their list of histories under "histories",
+the same shape as RT.get_ticket().content.
+"""
+import random
+from datetime import datetime
+from datetime import timedelta
+
+property_time_format = "%a %b %d %H:%M:%S %Y"
+history_time_format = "%Y-%m-%d %H:%M:%S"
+
+staff = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi"]
+categories = {"Accounts": ["Password reset", "Odin account", "Google apps"],
+              "Network": ["Wireless", "VPN", "Wired"],
+              "Software": ["Office", "Antivirus", "Licensing"],
+              "Hardware": ["Laptop", "Printer"],
+              }
+subjects = ["Can't log in", "Password reset", "eduroam won't connect", "VPN keeps dropping",
+            "Printer in the library is jammed", "Need Office license", "Laptop running slow",
+            "Google drive sharing: permission denied", "Email bouncing # again"]
+words = ("the a to my and is it can't when I have been with this on error but not after "
+         "password laptop network wifi account email login printer office drive update restart").split()
+
+
+def paragraph(rng, min_words=5, max_words=60):
+    """ Returns a few lines of random email text. """
+    text = " ".join(rng.choice(words) for _ in range(rng.randint(min_words, max_words)))
+    lines = []
+    while len(text) > 70:
+        cut = text.rfind(" ", 0, 70)
+        lines.append(text[:cut])
+        text = text[cut+1:]
+    lines.append(text)
+    return "\n".join(lines)
+
+
+class Corpus:
+    """
+    Generates tickets with random but realistic histories: a user creates the ticket, staff and user trade
+    correspondence, someone comments, tags it and resolves it (most of the time).
+    """
+
+    def __init__(self, tickets=1000, min_histories=2, max_histories=12, days=400, content_lines=1, seed=0, first_ticket=700000):
+        """
+        tickets (int): Amount of tickets.
+        min_histories, max_histories (int): Range of correspondences and comments per ticket.
+        days (int): Tickets are created over this many days before now.
+        content_lines (int): Paragraphs in each email body, to make histories bigger.
+        """
+        self.rng = random.Random(seed)
+        self.min_histories = min_histories
+        self.max_histories = max_histories
+        self.content_lines = content_lines
+        self.next_transaction = 1000000
+        self.tickets = {}
+        now = datetime.utcnow().replace(microsecond=0)
+        for i in range(tickets):
+            created = now - timedelta(seconds=self.rng.randint(0, days * 86400))
+            self.tickets[first_ticket + i] = self.make_ticket(first_ticket + i, created, now)
+
+
+    def transaction(self, ticket_number, type_, creator, time, description, content="", **fields):
+        self.next_transaction += 1
+        history = {"id": str(self.next_transaction),
+                   "Ticket": str(ticket_number),
+                   "TimeTaken": "0",
+                   "Type": type_,
+                   "Field": fields.get("Field", ""),
+                   "OldValue": fields.get("OldValue", ""),
+                   "NewValue": fields.get("NewValue", ""),
+                   "Data": "",
+                   "Description": description,
+                   "Content": content or "This transaction appears to have no content",
+                   "Creator": creator,
+                   "Created": time.strftime(history_time_format),
+                   "Attachments": "",
+                   }
+        return history
+
+
+    def email(self):
+        return "\n\n".join(paragraph(self.rng) for _ in range(self.content_lines))
+
+
+    def make_ticket(self, ticket_number, created, now):
+        rng = self.rng
+        user = "user{}@pdx.edu".format(rng.randint(1, 5000))
+        creator = "qthelper" if rng.random() < 0.05 else user
+        time = created
+        histories = [self.transaction(ticket_number, "Create", creator, time, "Ticket created by " + creator, self.email())]
+
+        for _ in range(rng.randint(self.min_histories, self.max_histories)):
+            time += timedelta(seconds=rng.choice([rng.randint(60, 3600), rng.randint(3600, 5 * 86400)]))
+            if time > now:
+                break
+            roll = rng.random()
+            if roll < 0.45:
+                person = rng.choice(staff)
+                histories.append(self.transaction(ticket_number, "Correspond", person, time,
+                                                  "Correspondence added by " + person, self.email()))
+            elif roll < 0.8:
+                histories.append(self.transaction(ticket_number, "Correspond", user, time,
+                                                  "Correspondence added by " + user, self.email()))
+            else:
+                person = rng.choice(staff)
+                histories.append(self.transaction(ticket_number, "Comment", person, time,
+                                                  "Comments added by " + person, self.email()))
+
+        category = subcategory = ""
+        if rng.random() < 0.85:
+            category = rng.choice(sorted(categories))
+            subcategory = rng.choice(categories[category])
+            person = rng.choice(staff)
+            histories.append(self.transaction(ticket_number, "CustomField", person, time,
+                                              "USS_Ticket_Category " + category + " added by " + person,
+                                              NewValue=category))
+
+        status = rng.choice(["resolved"] * 6 + ["open", "new", "stalled", "rejected"])
+        resolved = None
+        if status in ["resolved", "rejected"]:
+            person = rng.choice(staff)
+            time += timedelta(seconds=rng.randint(60, 3600))
+            histories.append(self.transaction(ticket_number, "Status", person, time,
+                                              "Status changed from 'open' to '" + status + "' by " + person,
+                                              Field="Status", OldValue="open", NewValue=status))
+            resolved = time
+
+        properties = {"id": "ticket/" + str(ticket_number),
+                      "Queue": "uss-helpdesk",
+                      "Owner": "Nobody",
+                      "Creator": creator,
+                      "Subject": rng.choice(subjects),
+                      "Status": status,
+                      "Priority": "0",
+                      "Requestors": user,
+                      "Created": created.strftime(property_time_format),
+                      "Starts": "Not set",
+                      "Due": "Not set",
+                      "Resolved": resolved.strftime(property_time_format) if resolved else "Not set",
+                      "LastUpdated": time.strftime(property_time_format),
+                      "TimeWorked": "0",
+                      "CF.{USS_Ticket_Category}": category,
+                      "CF.{USS_Ticket_Subcategory}": subcategory,
+                      "histories": histories,
+                      }
+        return properties
+
+
+    def touch(self, ticket_number, time=None):
+        """ Someone replies to the ticket. Adds a correspondence and bumps its LastUpdated. """
+        ticket = self.tickets[ticket_number]
+        time = time or datetime.utcnow().replace(microsecond=0)
+        person = self.rng.choice(staff)
+        ticket["histories"].append(self.transaction(ticket_number, "Correspond", person, time,
+                                                    "Correspondence added by " + person, self.email()))
+        ticket["LastUpdated"] = time.strftime(property_time_format)
@@ -0,0 +1,301 @@
+"""
+Local stand-in for RT's REST 1.0 API, serving a Corpus.
+Implements login, search/ticket (format i, s and l, with fields), ticket/<n>/show, ticket/<n>/history
+(short and format=l) and ticket/<n>/history/id/<id>. Latency and server errors can be injected.
+
+Run on its own (from the top directory): python bench/fake_rt.py [--port 8080] [--tickets 1000]
+"""
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+status_line = "RT/4.2.12 200 Ok"
+date_fields = ["created", "lastupdated", "resolved", "starts", "started", "due", "told"]
+
+
+def render(record):
+    """ Returns the record in RT's "key: value" format, with multi-line values indented under their key. """
+    lines = []
+    for key, value in record.items():
+        value_lines = str(value).split("\n")
+        lines.append(key + ": " + value_lines[0])
+        lines += [" " * (len(key) + 2) + line for line in value_lines[1:]]
+    return "\n".join(lines)
+
+
+def parse_date(value):
+    """ Returns a datetime from an RT property date or a TicketSQL date, None if not set. """
+    value = value.strip()
+    relative = re.match(r"now\s*-\s*([0-9]+)\s*(minute|hour|day|week)s?$", value, re.IGNORECASE)
+    if relative:
+        return datetime.utcnow() - timedelta(**{relative.group(2).lower() + "s": int(relative.group(1))})
+    for time_format in ("%a %b %d %H:%M:%S %Y", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    return None
+
+
+class Query:
+    """
+    Evaluates TicketSQL against a ticket's properties. Kept separate from rt/query.py on purpose,
+    so the bot's local search is checked against something it doesn't share code with.
+    """
+    token_re = re.compile(r"""\s*(\(|\)|'[^']*'|"[^"]*"|!=|<>|>=|<=|=|>|<|CF\.\{[^}]*\}|[\w.-]+)""", re.IGNORECASE)
+
+    def __init__(self, query):
+        self.tokens = self.token_re.findall(query)
+        self.pos = 0
+        self.match = self.expr()
+
+    def take(self):
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def peek(self):
+        return self.tokens[self.pos].upper() if self.pos < len(self.tokens) else None
+
+    def expr(self):
+        terms = [self.term()]
+        while self.peek() == "OR":
+            self.take()
+            terms.append(self.term())
+        return lambda t: any(term(t) for term in terms)
+
+    def term(self):
+        factors = [self.factor()]
+        while self.peek() == "AND":
+            self.take()
+            factors.append(self.factor())
+        return lambda t: all(factor(t) for factor in factors)
+
+    def factor(self):
+        if self.peek() == "(":
+            self.take()
+            inner = self.expr()
+            self.take()  # )
+            return inner
+        field = self.take()
+        op = self.take().upper()
+        if op == "IS":
+            negate = self.peek() == "NOT"
+            if negate:
+                self.take()
+            self.take()  # NULL
+            return lambda t: (self.value(t, field) in [None, ""]) != negate
+        expected = self.take().strip("'\"")
+        if field.lower() in date_fields:
+            expected = parse_date(expected)
+        elif field.lower() == "id":
+            expected = int(expected)
+        compare = {"=": lambda a, b: a == b, "!=": lambda a, b: a != b, "<>": lambda a, b: a != b,
+                   ">": lambda a, b: a > b, "<": lambda a, b: a < b, ">=": lambda a, b: a >= b,
+                   "<=": lambda a, b: a <= b, "LIKE": lambda a, b: b.lower() in a.lower()}[op]
+        def match(t):
+            actual = self.value(t, field)
+            if actual is None:
+                return False
+            if isinstance(actual, str) and isinstance(expected, str) and op != "LIKE":
+                return compare(actual.lower(), expected.lower())
+            return compare(actual, expected)
+        return match
+
+    def value(self, ticket, field):
+        if field.lower() == "id":
+            return int(ticket["id"].split("/")[1])
+        for key in ticket:
+            if key.lower() == field.lower():
+                if field.lower() in date_fields:
+                    return parse_date(ticket[key])
+                return ticket[key]
+        return None
+
+
+class FakeRT(ThreadingMixIn, HTTPServer):
+    """
+    corpus (Corpus): Tickets to serve.
+    latency (float): Seconds every request waits before being answered.
+    error_rate (float): Chance of a request failing with a 500.
+    """
+    daemon_threads = True
+
+    def __init__(self, corpus, port=0, latency=0.0, error_rate=0.0, seed=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), Handler)
+        self.corpus = corpus
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.sessions = set()
+        self.lock = threading.Lock()
+        self.request_counts = {}  # {endpoint: count}
+        self.url = "http://127.0.0.1:{}/REST/1.0/".format(self.server_address[1])
+
+    def start(self):
+        """ Serve in a background thread. """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def count(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def reset_counts(self):
+        with self.lock:
+            self.request_counts = {}
+
+    def expire_sessions(self):
+        """ Log everyone out, the next requests get redirected to SSO. """
+        with self.lock:
+            self.sessions.clear()
+
+    # Responses.
+
+    def search(self, params):
+        query = Query(params.get("query", [""])[0])
+        orderby = params.get("orderby", ["-created"])[0]
+        format_ = params.get("format", ["s"])[0]
+        fields = params.get("fields", [None])[0]
+
+        tickets = [t for t in self.corpus.tickets.values() if query.match(t)]
+        key = orderby.lstrip("+-")
+        tickets.sort(key=lambda t: query.value(t, key) or datetime.min, reverse=orderby.startswith("-"))
+        if not tickets:
+            return status_line + "\n\nNo matching results.\n"
+
+        if format_ == "i":
+            return status_line + "\n\n" + "\n".join(t["id"] for t in tickets) + "\n"
+        if format_ == "s":
+            return status_line + "\n\n" + "\n".join(t["id"].split("/")[1] + ": " + t["Subject"] for t in tickets) + "\n"
+        records = []
+        for t in tickets:
+            record = {k: v for k, v in t.items() if k != "histories"}
+            if fields:
+                wanted = ["id"] + fields.split(",")
+                record = {k: v for k, v in record.items() if k in wanted}
+            records.append(render(record))
+        return status_line + "\n\n" + "\n\n--\n\n".join(records) + "\n"
+
+    def show(self, ticket):
+        return status_line + "\n\n" + render({k: v for k, v in ticket.items() if k != "histories"}) + "\n\n"
+
+    def histories(self, ticket):
+        histories = ticket["histories"]
+        chunks = ["# {}/{} (id/{}/total)\n\n".format(i + 1, len(histories), h["id"]) + render(h)
+                  for i, h in enumerate(histories)]
+        return status_line + "\n\n" + "\n\n--\n\n".join(chunks) + "\n"
+
+    def history_ids(self, ticket):
+        histories = ticket["histories"]
+        return status_line + "\n\n# {}/{} (/total)\n\n".format(len(histories), len(histories)) + \
+               "\n".join(h["id"] + ": " + h["Description"] for h in histories) + "\n"
+
+    def history(self, ticket, transaction_id):
+        for h in ticket["histories"]:
+            if h["id"] == transaction_id:
+                return status_line + "\n\n# 1/1 (id/{}/total)\n\n".format(h["id"]) + render(h) + "\n"
+        return status_line + "\n\n# Transaction " + transaction_id + " is not related to Ticket\n"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like RT behind Apache.
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body="", headers=None):
+        data = body.encode("utf-8")
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def injected(self):
+        """ Wait out the latency, and return True if this request should fail. """
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        with self.server.lock:
+            fail = self.server.rng.random() < self.server.error_rate
+        if fail:
+            self.reply(500, "Internal Server Error")
+        return fail
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.server.count("login")
+        if self.injected():
+            return
+        session = "%032x" % self.server.rng.getrandbits(128)
+        with self.server.lock:
+            self.server.sessions.add(session)
+        self.reply(200, status_line + "\n\n", {"Set-Cookie": "RT_SID_fake=" + session + "; path=/"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.split("/REST/1.0/", 1)[-1]
+        params = parse_qs(url.query)
+
+        cookie = self.headers.get("Cookie", "")
+        session = re.search(r"RT_SID_fake=(\w+)", cookie)
+        with self.server.lock:
+            logged_in = session and session.group(1) in self.server.sessions
+        if not logged_in:
+            self.server.count("redirect")
+            self.reply(302, "", {"Location": "/NoAuthCAS/"})
+            return
+
+        match = re.match(r"ticket/(\w+)/(show|history)(?:/id/(\w+))?$", path)
+        endpoint = "search" if path == "search/ticket" else \
+                   (match.group(2) + ("/id" if match.group(3) else "") if match else "other")
+        self.server.count(endpoint)
+        if self.injected():
+            return
+
+        if path == "search/ticket":
+            self.reply(200, self.server.search(params))
+            return
+        if not match:
+            self.reply(404, "Not found")
+            return
+        if not match.group(1).isdigit():
+            self.reply(200, status_line + "\n\n# Objects of type ticket must be specified by numeric id.\n")
+            return
+        ticket = self.server.corpus.tickets.get(int(match.group(1)))
+        if ticket is None:
+            self.reply(200, status_line + "\n\n# Ticket " + match.group(1) + " does not exist.\n")
+        elif match.group(2) == "show":
+            self.reply(200, self.server.show(ticket))
+        elif match.group(3):
+            self.reply(200, self.server.history(ticket, match.group(3)))
+        elif params.get("format", [""])[0] == "l":
+            self.reply(200, self.server.histories(ticket))
+        else:
+            self.reply(200, self.server.history_ids(ticket))
+
+
+if __name__ == "__main__":
+    import argparse
+    from corpus import Corpus
+
+    parser = argparse.ArgumentParser(description="Fake RT REST 1.0 server.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--tickets", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeRT(Corpus(args.tickets), args.port, args.latency, args.error_rate)
+    print("Serving {} tickets at {}".format(args.tickets, server.url))
+    server.serve_forever()
@@ -0,0 +1,74 @@
+"""
+Check the RT response parser against the old yaml parser, then time both.
+Files in the corpus are raw RT responses: history_<n>.txt from ticket/<n>/history?format=l
+and show_<n>.txt from ticket/<n>/show.
+
+Usage (from the top directory): python bench/parser_bench.py [corpus files...]
+"""
+import os
+import sys
+import timeit
+from glob import glob
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from rt import rest_parser
+
+corpus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+
+def parsers_for(file_name):
+    """ Returns the (new, old) parser for the type of response in the file. """
+    if os.path.basename(file_name).startswith("show"):
+        return rest_parser.parse_properties, lambda text: rest_parser.yaml_parse_properties(text)
+    return lambda text: list(rest_parser.iter_histories(text)), rest_parser.yaml_parse_histories
+
+
+def same_value(new, old):
+    """
+    The yaml parser folds multi-line values (and keeps part of their indentation),
+    while the new parser keeps the line breaks. Multi-line values are compared word by word.
+    """
+    if "\n" not in new and "\n" not in old:
+        return new == old
+    return new.split() == old.split()
+
+
+def compare(new_records, old_records):
+    """ Returns a list of differences between the two parsers' results. """
+    if isinstance(new_records, dict):
+        new_records, old_records = [new_records], [old_records]
+    if len(new_records) != len(old_records):
+        return ["{} records instead of {}".format(len(new_records), len(old_records))]
+    differences = []
+    for i, (new, old) in enumerate(zip(new_records, old_records)):
+        if new.keys() != old.keys():
+            differences.append("record {}: keys {} instead of {}".format(i, sorted(new), sorted(old)))
+            continue
+        for key in new:
+            if not same_value(new[key], old[key]):
+                differences.append("record {}: {} is {!r} instead of {!r}".format(i, key, new[key], old[key]))
+    return differences
+
+
+if __name__ == "__main__":
+    file_names = sys.argv[1:] or sorted(glob(os.path.join(corpus_dir, "*.txt")))
+    failed = False
+    for file_name in file_names:
+        with open(file_name) as f:
+            text = f.read()
+        new_parser, old_parser = parsers_for(file_name)
+
+        differences = compare(new_parser(text), old_parser(text))
+        if differences:
+            failed = True
+            print("MISMATCH " + file_name)
+            for difference in differences:
+                print("    " + difference)
+
+        runs = 200
+        new_time = timeit.timeit(lambda: new_parser(text), number=runs) / runs
+        old_time = timeit.timeit(lambda: old_parser(text), number=runs) / runs
+        print("{:<24} new {:8.1f}us  yaml {:8.1f}us  ({:.1f}x)".format(
+            os.path.basename(file_name), new_time * 1e6, old_time * 1e6, old_time / new_time))
+
+    sys.exit(1 if failed else 0)
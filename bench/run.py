@@ -0,0 +1,205 @@
+"""
+Benchmark suite, run against the fake RT server with a synthetic corpus.
+Times the parsers, a full cache backfill, an incremental update, get_ticket_from_cache and each RT_Stat command.
+Results are written as json so that runs can be compared.
+
+Usage (from the top directory):
+    python bench/run.py [--tickets 2000] [--latency 0.005] [--output bench/results/before.json]
+    python bench/run.py --baseline bench/results/before.json
+"""
+import argparse
+import json
+import os
+import queue
+import random
+import sys
+import tempfile
+import time
+import timeit
+from datetime import date, datetime, timedelta
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, bench_dir)
+sys.path.insert(0, os.path.join(bench_dir, "..", "src"))
+from corpus import Corpus
+from fake_rt import FakeRT
+
+
+def best_of(f, repeat=3):
+    """ Returns the fastest time in seconds out of repeat calls of f. """
+    return min(timeit.repeat(f, number=1, repeat=repeat))
+
+
+def reference_working_time(calendar, start_utc, end_utc):
+    """
+    Working seconds between two moments (start before end), walking one local day at a time.
+    Checks BusinessCalendar, which looks the same thing up in prefix sums with its own copy of the timezone's offsets.
+    """
+    import pytz
+    start = datetime.fromtimestamp(start_utc, pytz.utc).astimezone(calendar.timezone).replace(tzinfo=None)
+    end = datetime.fromtimestamp(end_utc, pytz.utc).astimezone(calendar.timezone).replace(tzinfo=None)
+    total = 0
+    day = start.date()
+    while day <= end.date():
+        if (day - date(1970, 1, 1)).days not in calendar.holidays:
+            opening, closing = calendar.hours.get(day.weekday(), (0, 0))
+            midnight = datetime.combine(day, datetime.min.time())
+            overlap = min(end, midnight + timedelta(seconds=closing)) - max(start, midnight + timedelta(seconds=opening))
+            total += max(int(overlap.total_seconds()), 0)
+        day += timedelta(days=1)
+    return total
+
+
+def check_calendar(calendar, intervals=2000):
+    """ Compare the calendar with reference_working_time() on random intervals of up to 30 days since 2012. """
+    rng = random.Random(0)
+    for _ in range(intervals):
+        start = rng.randint(1325376000, 1767225600)  # 2012-01-01 to 2026-01-01.
+        end = start + rng.randint(0, 30 * 86400)
+        assert calendar.working_time(start, end) == reference_working_time(calendar, start, end), (start, end)
+
+
+def run(args):
+    results = {}
+    corpus = Corpus(args.tickets, args.min_histories, args.max_histories, content_lines=args.content_lines)
+    server = FakeRT(corpus, latency=args.latency, error_rate=args.error_rate).start()
+
+    cache_dir = tempfile.mkdtemp(prefix="bench_cache_") + "/"
+    with open(cache_dir + "last_updated", "w") as f:
+        f.write("2000-01-01")
+    os.environ["RT_BASE_URL"] = server.url
+    os.environ["RT_CACHE_DIR"] = cache_dir
+    os.environ["RT_CREDENTIALS"] = "bench:bench"
+
+    start = time.time()
+    from rt import RT, RT_Stat, rest_parser
+    from rt.store import TicketStore
+    from rt.rt_stat import untagged_partial, untagged_merge
+    from rt import business_calendar, response_time
+    results["import_rt"] = time.time() - start
+
+    # Parsers, on the responses the server gives for a sample of tickets.
+    sample = list(corpus.tickets.values())[:200]
+    history_texts = [server.histories(t) for t in sample]
+    show_texts = [server.show(t) for t in sample]
+    results["parse_histories_per_ticket"] = best_of(lambda: [list(rest_parser.iter_histories(t)) for t in history_texts]) / len(sample)
+    results["parse_properties_per_ticket"] = best_of(lambda: [rest_parser.parse_properties(t) for t in show_texts]) / len(sample)
+
+    # Full backfill of the cache.
+    server.reset_counts()
+    start = time.time()
+    errors = RT._update_cache(queue.Queue())
+    results["update_full"] = time.time() - start
+    results["update_full_tickets_per_sec"] = args.tickets / results["update_full"]
+    results["update_full_errors"] = errors
+    results["update_full_requests"] = sum(server.request_counts.values())
+
+    # Incremental update after a tenth of the tickets got a reply.
+    for ticket_number in list(corpus.tickets)[::10]:
+        corpus.touch(ticket_number)
+    with open(cache_dir + "last_updated", "w") as f:
+        f.write("2000-01-01")
+    server.reset_counts()
+    start = time.time()
+    RT._update_cache(queue.Queue())
+    results["update_incremental"] = time.time() - start
+    results["update_incremental_requests"] = sum(server.request_counts.values())
+
+    # Reading the cache.
+    ticket_numbers = list(corpus.tickets)
+    def read_all():
+        for ticket_number in ticket_numbers:
+            RT.get_ticket_from_cache(ticket_number)
+    def read_cold():
+        RT.ticket_cache.clear()
+        read_all()
+    results["get_ticket_from_cache_cold_per_ticket"] = best_of(read_cold) / len(ticket_numbers)
+    read_all()
+    results["get_ticket_from_cache_warm_per_ticket"] = best_of(read_all) / len(ticket_numbers)
+
+    # Working time, on the default calendar and on one with staffed hours and holidays.
+    check_calendar(business_calendar.default)
+    check_calendar(business_calendar.BusinessCalendar(
+        holidays=[date(year, 12, 25) for year in range(2012, 2027)] + [date(year, 7, 4) for year in range(2012, 2027)],
+        hours={weekday: (8 * 3600, 17 * 3600) for weekday in range(5)}))
+
+    # Response times of every ticket, in one batch like the store computes them, against one ticket at a time.
+    tickets = [RT.get_ticket_from_cache(ticket_number) for ticket_number in ticket_numbers]
+    assert response_time.response_times(tickets) == [t.get_response_time() for t in tickets]
+    results["response_times_batch_per_ticket"] = best_of(lambda: response_time.response_times(tickets)) / len(tickets)
+    results["response_times_scalar_per_ticket"] = best_of(lambda: [t.get_response_time() for t in tickets]) / len(tickets)
+
+    # Size of the cache on disk, and reading every ticket back through a new connection with nothing parsed in memory.
+    RT.store.connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    results["cache_bytes"] = sum(os.path.getsize(cache_dir + name) for name in os.listdir(cache_dir)
+                                 if name.startswith("tickets.db"))
+    def scan_cold():
+        store = TicketStore(RT.store.path)
+        for ticket_number in ticket_numbers:
+            store.get_ticket(ticket_number)
+    results["cache_scan_cold"] = best_of(scan_cold)
+
+    # Stats commands, computed every time rather than served from the results cache.
+    rt_stat = RT_Stat()
+    results["stat_response_30"] = best_of(lambda: rt_stat.compute_average_response_time(30))
+    results["stat_response_365"] = best_of(lambda: rt_stat.compute_average_response_time(365))
+    results["stat_touches_30"] = best_of(lambda: rt_stat.compute_ticket_touches(30))
+    results["stat_untagged"] = best_of(rt_stat.compute_untag_blame)
+    rt_stat.get_average_response_time(365)
+    results["stat_response_365_cached"] = best_of(lambda: rt_stat.get_average_response_time(365))
+
+    # The untagged table kept by the store, checked against the scan over RT's search that it replaced.
+    untagged_list, cached = rt_stat.scan(untagged_partial, untagged_merge, RT.search_query(RT.untagged_query))
+    assert rt_stat.compute_untag_blame() == (untagged_list if cached else None)
+
+    # The same scans split across processes, checked against the serial results.
+    parallel = RT_Stat(processes=args.processes)
+    RT_Stat.parallel_threshold = 0
+    assert parallel.compute_average_response_time(365) == rt_stat.compute_average_response_time(365)
+    assert parallel.compute_ticket_touches(30) == rt_stat.compute_ticket_touches(30)
+    assert parallel.compute_untag_blame() == rt_stat.compute_untag_blame()
+    results["stat_response_365_parallel"] = best_of(lambda: parallel.compute_average_response_time(365))
+    results["stat_untagged_parallel"] = best_of(parallel.compute_untag_blame)
+
+    server.shutdown()
+    return results
+
+
+def compare(results, baseline):
+    """ Print each result next to the baseline's. """
+    print("{:<40} {:>14} {:>14} {:>8}".format("benchmark", "baseline", "now", "change"))
+    for name in sorted(results):
+        now = results[name]
+        before = baseline.get(name)
+        if before:
+            change = "{:+.0%}".format((now - before) / before)
+        else:
+            change = ""
+        print("{:<40} {:>14.6g} {:>14.6g} {:>8}".format(name, before or 0, now, change))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmarks against a fake RT server.")
+    parser.add_argument("--tickets", type=int, default=2000)
+    parser.add_argument("--min-histories", type=int, default=2)
+    parser.add_argument("--max-histories", type=int, default=12)
+    parser.add_argument("--content-lines", type=int, default=1, help="Paragraphs in each email body.")
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds added to every request.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Chance of a request failing with a 500.")
+    parser.add_argument("--processes", type=int, default=4, help="Processes for the parallel stats scans.")
+    parser.add_argument("--output", default=os.path.join(tempfile.gettempdir(), "rt_bench_latest.json"),
+                        help="Where to write the results json. Defaults to outside the repository.")
+    parser.add_argument("--baseline", help="Results json of an earlier run to compare against.")
+    args = parser.parse_args()
+
+    results = run(args)
+    record = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "config": vars(args), "results": results}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(record, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    compare(results, baseline)
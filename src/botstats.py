@@ -0,0 +1,30 @@
+import time
+import traceback
+from listener import Listener
+import metrics
+
+
+class BotStats:
+    """
+    !botstats replies with the bot's metrics (see metrics.py).
+    If metrics_file is set the metrics are also written there every dump_interval seconds,
+    in Prometheus' text format for node_exporter's textfile collector or anything else that scrapes it.
+    """
+    def __init__(self, client, metrics_file=None, dump_interval=60):
+        self.client = client
+        self.metrics_file = metrics_file
+        self.dump_interval = dump_interval
+        self.last_dump = 0
+        Listener.register(self.on_loop, "on_loop")
+        Listener.register_command(self.botstats_handler, ["!botstats"])
+
+    def on_loop(self):
+        if self.metrics_file and metrics.enabled and time.time() - self.last_dump > self.dump_interval:
+            self.last_dump = time.time()
+            try:
+                metrics.dump(self.metrics_file)
+            except OSError:
+                traceback.print_exc()
+
+    def botstats_handler(self, ctx):
+        self.client.rtm_send_message(ctx.channel, "```" + metrics.summary() + "```")
@@ -1,14 +1,84 @@
+import re
+import time
+import traceback
+import metrics
+
+
 class Listener:
     listeners = {"on_message": [],
                  "on_ready": [],
                  "on_loop": [],
+                 "on_error": [],
 		}
+    commands = {}  # {"!command": handler}, messages are routed by their first word.
+    patterns = []  # List of (compiled regex, handler) for messages that aren't commands.
+    slow_call = 2.0  # Seconds a handler can take before the call gets logged.
 
     @classmethod
     def update(cls, event, *args):
+        if event == "on_message":
+            cls.route(*args)
         for listener in cls.listeners[event]:
-            listener(*args)
+            cls.call(listener, *args)
 
     @classmethod
     def register(cls, f, event):
         cls.listeners[event].append(f)
+
+    @classmethod
+    def register_command(cls, f, commands):
+        """
+        f (function): Called with the message's Context.
+        commands (list): Commands that f handles, ex: ["!touch", "!tt"].
+        """
+        for command in commands:
+            cls.commands[command] = f
+
+    @classmethod
+    def register_pattern(cls, f, pattern):
+        """
+        f (function): Called with the message's Context.
+        pattern (str): Regex searched for in every message that isn't a command.
+        """
+        cls.patterns.append((re.compile(pattern), f))
+
+    @classmethod
+    def route(cls, ctx):
+        """ Call the handler of the message's command, or the pattern handlers that match if it isn't a command. """
+        handler = cls.commands.get(ctx.command)
+        if handler:
+            cls.call(handler, ctx)
+            return
+        if not ctx.message or ctx.command.startswith("!"):
+            return
+        for regex, handler in cls.patterns:
+            if regex.search(ctx.message):
+                cls.call(handler, ctx)
+
+    @classmethod
+    def call(cls, f, *args):
+        """
+        Call a handler, keeping track of how long it takes and whether it fails (see the bot_handler_* metrics).
+        Errors don't stop the bot. They are printed and passed on to the on_error listeners with the handler's arguments.
+        """
+        name = getattr(f, "__qualname__", repr(f))
+        start = time.time()
+        failed = False
+        try:
+            f(*args)
+        except Exception as e:
+            failed = True
+            traceback.print_exc()
+            for listener in cls.listeners["on_error"]:
+                try:
+                    listener(e, *args)
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            elapsed = time.time() - start
+            metrics.observe("bot_handler_seconds", elapsed, handler=name)
+            if failed:
+                metrics.inc("bot_handler_errors_total", handler=name)
+            if elapsed > cls.slow_call:
+                print("Slow call: {} took {:.2f}s".format(name, elapsed))
+
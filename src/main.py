@@ -1,9 +1,12 @@
-from listener import Listener
+import time
+started = time.time()  # Before the other imports, startup time includes them.
 from kudos import Kudos
+from botstats import BotStats
+import metrics
+import os
 import ticket
+from runtime import Runtime
 from slackclient import SlackClient
-import time
-from pprint import pprint
 
 
 class Context:
@@ -26,13 +29,15 @@ class Context:
         self.channel = event["channel"]
 
 
-def parse_events(events):
-    print(events)
-    for event in events:
+def parse_event(event):
+    """ Returns the event's Context if it is a message, otherwise None. """
+    print(event)
+    if "type" in event and event["type"] == "message" and "text" in event:
         ctx = Context()
-        if "type" in event and event["type"] == "message" and "text" in event:
-            ctx.message_event(event)
-            Listener.update("on_message", ctx)
+        ctx.message_event(event)
+        if ctx.message:
+            return ctx
+    return None
 
 
 if __name__ == "__main__":
@@ -40,14 +45,17 @@ if __name__ == "__main__":
     slack_token = f.read().strip()
     f.close()
     sc = SlackClient(slack_token)
-    kudos = Kudos(sc)
-    ticket = ticket.Ticket(sc)
+    # BOT_METRICS=0 turns metrics off, BOT_METRICS_FILE is where they get dumped for Prometheus.
+    metrics.enabled = os.environ.get("BOT_METRICS", "1") != "0"
+    runtime = Runtime(sc, parse_event)
+    kudos = Kudos(runtime.client)
+    botstats = BotStats(runtime.client, os.environ.get("BOT_METRICS_FILE"))
+    ticket = ticket.Ticket(runtime.client)
 
     if sc.rtm_connect():
-        Listener.update("on_ready")
-        while True:
-            parse_events(sc.rtm_read())
-            Listener.update("on_loop")
-            time.sleep(0.3)
+        startup = time.time() - started
+        metrics.set_gauge("bot_startup_seconds", startup)
+        print("Listening on RTM, {:.2f}s after starting".format(startup))
+        runtime.run()
     else:
         print("Connection failed")
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+
+# Counters, gauges and latency histograms for the bot, shown by !botstats and dumped in Prometheus' text format.
+# Everything is a no-op while enabled is False, so instrumented code costs next to nothing when metrics are off.
+
+enabled = False
+lock = threading.Lock()
+counters = {}  # {(name, labels): value}, labels being a sorted tuple of (key, value).
+gauges = {}
+histograms = {}
+collectors = []  # Functions returning {(name, labels): value} of gauges, called when metrics are read.
+# Upper bounds in seconds of the latency buckets.
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf.
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(buckets) and value > buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name, amount=1, **labels):
+    """ Add amount to a counter. """
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    if not enabled:
+        return
+    with lock:
+        gauges[_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    """ Record a latency in the histogram of name. """
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+def register_collector(f):
+    """ f (function): Returns a dictionary of {(name, labels dict or None): value} to report as gauges. """
+    collectors.append(f)
+
+
+def _collected():
+    ret = {}
+    for f in collectors:
+        for (name, labels), value in f().items():
+            ret[_key(name, labels or {})] = value
+    return ret
+
+
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+def prometheus_text():
+    """ Returns every metric in Prometheus' text exposition format. """
+    lines = []
+    with lock:
+        for (name, labels), value in sorted(counters.items()):
+            lines.append("{}{} {}".format(name, _labels(labels), value))
+        all_gauges = dict(gauges)
+        all_histograms = dict(histograms)
+    all_gauges.update(_collected())
+    for (name, labels), value in sorted(all_gauges.items()):
+        lines.append("{}{} {}".format(name, _labels(labels), value))
+    for (name, labels), histogram in sorted(all_histograms.items()):
+        cumulative = 0
+        for bound, count in zip(buckets + ("+Inf",), histogram.counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(name, _labels(labels, [("le", bound)]), cumulative))
+        lines.append("{}_sum{} {}".format(name, _labels(labels), histogram.sum))
+        lines.append("{}_count{} {}".format(name, _labels(labels), histogram.count))
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    """ Write prometheus_text() to path, replacing the file in one go so readers never see half of it. """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+
+def summary():
+    """ Returns a short human readable report of the metrics, for Slack. """
+    if not enabled:
+        return "Metrics are turned off."
+    lines = []
+    with lock:
+        all_histograms = sorted(histograms.items())
+        all_counters = sorted(counters.items())
+    for (name, labels), histogram in all_histograms:
+        lines.append("{}{}: {} calls, avg {:.3f}s, max {:.3f}s".format(
+            name, _labels(labels), histogram.count, histogram.sum / histogram.count, histogram.max))
+    for (name, labels), value in all_counters:
+        lines.append("{}{}: {}".format(name, _labels(labels), value))
+    with lock:
+        all_gauges = dict(gauges)
+    all_gauges.update(_collected())
+    for (name, labels), value in sorted(all_gauges.items()):
+        lines.append("{}{}: {}".format(name, _labels(labels), round(value, 3) if isinstance(value, float) else value))
+    return "\n".join(lines)
+
+
+def since(start):
+    """ Shortener for the seconds passed since start (a time.time()). """
+    return time.time() - start
@@ -0,0 +1,150 @@
+from collections import deque
+import metrics
+
+fence = "```"
+
+
+def cut_line(line, width):
+    """ Returns the line cut into segments of at most width characters, without cutting through a run of backticks. """
+    segments = []
+    while len(line) > width:
+        cut = width
+        while cut > 0 and line[cut-1] == "`":
+            cut -= 1
+        cut = cut or width
+        segments.append(line[:cut])
+        line = line[cut:]
+    segments.append(line)
+    return segments
+
+
+def split_message(message, limit):
+    """
+    Returns the message cut into pieces of at most limit characters, on line boundaries when possible.
+    A code block that gets cut is closed at the end of its piece and opened again in the next one.
+    """
+    if len(message) <= limit:
+        return [message]
+    room = limit - 2 * (len(fence) + 1)  # Leave room to close and reopen a code block.
+    width = room - len(fence) - 1  # Lines longer than this are cut anywhere.
+    pieces = []
+    lines = []
+    size = -1  # Length of the lines joined by newlines.
+    in_fence = False  # Whether the lines so far end inside a code block.
+
+    def flush():
+        pieces.append("\n".join(lines) + ("\n" + fence if in_fence else ""))
+        return ([fence], len(fence)) if in_fence else ([], -1)
+
+    for line in message.split("\n"):
+        for segment in cut_line(line, width):
+            if lines and size + 1 + len(segment) > room:
+                lines, size = flush()
+            lines.append(segment)
+            size += 1 + len(segment)
+            if segment.count(fence) % 2:
+                in_fence = not in_fence
+    if lines:
+        flush()
+    return pieces
+
+
+class ChannelQueue:
+    def __init__(self):
+        self.pending = deque()  # Pieces of messages waiting to be sent, oldest first.
+        self.next_send = 0.0  # Time before which nothing may be sent to the channel.
+        self.failures = 0  # Failed sends in a row.
+
+
+class Outbox:
+    """
+    Outgoing Slack messages, waiting to be sent within Slack's limits.
+    - Messages longer than limit are split on line boundaries.
+    - Messages waiting for the same channel are merged into one when they fit.
+    - A channel gets at most one message every channel_interval seconds, and all channels together
+      global_rate messages a second, in bursts of up to global_burst.
+    - A channel whose send fails waits backoff seconds, doubled on every failure in a row up to max_backoff.
+      The message is dropped after max_attempts failures.
+    This only decides what to send and when. The runtime does the sending, see Runtime.send_messages().
+    """
+
+    def __init__(self, limit=4000, channel_interval=1.0, global_rate=1.0, global_burst=4,
+                 backoff=1.0, max_backoff=30.0, max_attempts=5):
+        self.limit = limit
+        self.channel_interval = channel_interval
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.channels = {}  # {channel: ChannelQueue}, kept once created so a channel's next_send holds.
+        self.tokens = float(global_burst)  # Sends the global rate allows right now.
+        self.refilled = None  # When tokens was last topped up.
+
+
+    def put(self, channel, message):
+        pieces = split_message(message, self.limit)
+        if len(pieces) > 1:
+            metrics.inc("bot_messages_split_total")
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = ChannelQueue()
+        queue.pending.extend(pieces)
+
+
+    def refill(self, now):
+        if self.refilled is not None:
+            self.tokens = min(self.global_burst, self.tokens + (now - self.refilled) * self.global_rate)
+        self.refilled = now
+
+
+    def pop(self, now):
+        """
+        Returns (channel, text) of the next message that may be sent now, or None.
+        Call sent() or failed() once it has been tried.
+        """
+        self.refill(now)
+        if self.tokens < 1:
+            return None
+        ready = [(queue.next_send, channel) for channel, queue in self.channels.items()
+                 if queue.pending and queue.next_send <= now]
+        if not ready:
+            return None
+        # The channel that has been able to send the longest goes first.
+        channel = min(ready)[1]
+        pending = self.channels[channel].pending
+        text = pending.popleft()
+        while pending and len(text) + 1 + len(pending[0]) <= self.limit:
+            text += "\n" + pending.popleft()
+            metrics.inc("bot_messages_coalesced_total")
+        self.tokens -= 1
+        return channel, text
+
+
+    def sent(self, channel, now):
+        queue = self.channels[channel]
+        queue.failures = 0
+        queue.next_send = now + self.channel_interval
+
+
+    def failed(self, channel, text, now):
+        """ Put the message back to be sent again after a backoff, unless it failed max_attempts times already. """
+        queue = self.channels[channel]
+        queue.failures += 1
+        queue.next_send = now + min(self.backoff * 2 ** (queue.failures - 1), self.max_backoff)
+        if queue.failures >= self.max_attempts:
+            print("Dropping message to {} after {} failed sends".format(channel, queue.failures))
+            metrics.inc("bot_messages_dropped_total")
+            queue.failures = 0
+        else:
+            queue.pending.appendleft(text)
+
+
+    def wait_time(self, now):
+        """ Returns the seconds until pop() might give a message, or None if there is nothing to send. """
+        waits = [queue.next_send - now for queue in self.channels.values() if queue.pending]
+        if not waits:
+            return None
+        self.refill(now)
+        token_wait = (1 - self.tokens) / self.global_rate if self.tokens < 1 else 0.0
+        return max(min(waits), token_wait, 0.0)
@@ -0,0 +1,45 @@
+"""
+Maintenance of the ticket cache, run from the src directory:
+    python -m rt --update
+    python -m rt --migrate
+    python -m rt --backfill-metrics
+    python -m rt --compact
+    python -m rt --rebuild-untagged
+"""
+import argparse
+from .rt import RT
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m rt", description="Maintain the ticket cache.")
+    actions = parser.add_mutually_exclusive_group(required=True)
+    actions.add_argument("-u", "--update", action="store_true", help="Update the cache since it was last updated.")
+    actions.add_argument("-m", "--migrate", action="store_true", help="Import a cache of one json file per ticket.")
+    actions.add_argument("--backfill-metrics", action="store_true", help="Recompute the stats of every cached ticket.")
+    actions.add_argument("--compact", action="store_true", help="Rewrite cached tickets in the compact format.")
+    actions.add_argument("--rebuild-untagged", action="store_true", help="Recompute the untagged tickets.")
+    args = parser.parse_args()
+
+    if args.update:
+        update_thread = RT.update_cache()
+        if update_thread is None:
+            print("An update is already running.")
+            return
+        update_thread.join()
+        report = None
+        while not update_thread.result.empty():
+            report = update_thread.result.get()
+        if report and report["failure"]:
+            raise SystemExit("Update stopped: " + report["failure"])
+    elif args.migrate:
+        RT.migrate_json_cache()
+    elif args.backfill_metrics:
+        RT.backfill_metrics()
+    elif args.compact:
+        RT.compact_cache()
+    elif args.rebuild_untagged:
+        print("Found {} untagged tickets".format(RT.rebuild_untagged()))
+
+
+if __name__ == "__main__":
+    main()
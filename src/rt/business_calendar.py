@@ -0,0 +1,114 @@
+import os
+import threading
+from bisect import bisect_right
+from datetime import date, datetime
+import pytz
+
+# Working time between two moments, for response times.
+# Only the staffed hours of working days count: weekends, holidays and the hours the helpdesk is closed don't.
+# The calendar keeps the working seconds of every day before each day (a prefix sum), so the working time
+# between any two moments is two lookups and a subtraction.
+
+sec_in_day = 86400
+epoch = date(1970, 1, 1)
+# {weekday (Monday is 0): (opening, closing) in seconds since local midnight}. Days left out are closed.
+staffed_hours = {weekday: (0, sec_in_day) for weekday in range(5)}
+# One date per line as YYYY-MM-DD, # starts a comment. Read if it exists.
+holidays_file = os.path.join(os.path.dirname(__file__), "..", "..", "holidays")
+
+
+def load_holidays(path):
+    """ Returns the list of dates in the holidays file, or an empty list if there is no such file. """
+    if not os.path.exists(path):
+        return []
+    holidays = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line:
+                holidays.append(datetime.strptime(line, "%Y-%m-%d").date())
+    return holidays
+
+
+class BusinessCalendar:
+    def __init__(self, holidays=(), hours=None, timezone="US/Pacific", first_day=date(2010, 1, 1)):
+        """
+        holidays (list): Dates that nobody works.
+        hours (dict): Staffed hours of each weekday, see staffed_hours. Defaults to staffed_hours.
+        timezone (str): Timezone the hours and dates are in.
+        first_day (date): Moments before this day don't count.
+        """
+        self.timezone = pytz.timezone(timezone)
+        self.holidays = set((day - epoch).days for day in holidays)
+        self.hours = staffed_hours if hours is None else hours
+        self.first_day = (first_day - epoch).days
+        # pytz's own table of UTC times where the timezone changes its offset, and the offset from then on.
+        transitions = getattr(self.timezone, "_utc_transition_times", None)
+        if transitions:
+            self.transition_times = [int((t - datetime(1970, 1, 1)).total_seconds()) for t in transitions]
+            self.transition_offsets = [int(info[0].total_seconds()) for info in self.timezone._transition_info]
+        else:
+            self.transition_times = [-2 ** 62]
+            self.transition_offsets = [int(self.timezone.utcoffset(datetime(2000, 1, 1)).total_seconds())]
+        # Per day since first_day: the working seconds of all the days before it, and its staffed hours.
+        self.cumulative = [0]
+        self.opens = []
+        self.closes = []
+        self.lock = threading.Lock()
+        self.extend((date.today() - epoch).days + 366)
+
+
+    def extend(self, last_day):
+        """ Compute the days up to last_day (in days since epoch), if they aren't already. """
+        with self.lock:
+            for day in range(self.first_day + len(self.opens), last_day + 1):
+                opening, closing = self.hours.get((day + 3) % 7, (0, 0))  # 1970-01-01 was a Thursday.
+                if day in self.holidays:
+                    opening = closing = 0
+                self.opens.append(opening)
+                self.closes.append(closing)
+                self.cumulative.append(self.cumulative[-1] + closing - opening)
+
+
+    def utc_offset(self, utc_seconds):
+        """ Returns the timezone's offset from UTC in seconds at the given time, the same way pytz picks it. """
+        return self.transition_offsets[max(bisect_right(self.transition_times, utc_seconds) - 1, 0)]
+
+
+    def working_seconds(self, utc_seconds):
+        """ Returns the working seconds from first_day up to the moment, given in seconds since epoch (UTC). """
+        local = utc_seconds + self.utc_offset(utc_seconds)
+        day = local // sec_in_day
+        i = day - self.first_day
+        if i < 0:
+            return 0
+        if i >= len(self.opens):
+            self.extend(day + 366)
+        elapsed = local - day * sec_in_day
+        return self.cumulative[i] + min(max(elapsed - self.opens[i], 0), self.closes[i] - self.opens[i])
+
+
+    def working_time(self, start_utc, end_utc):
+        """ Returns the working seconds between two moments, given in seconds since epoch (UTC). """
+        return self.working_seconds(end_utc) - self.working_seconds(start_utc)
+
+
+default = BusinessCalendar(load_holidays(holidays_file))
+
+
+_utc = pytz.utc
+_pacific = pytz.timezone('US/Pacific')
+_parsed = {}  # {time string: datetime}, RT times seen so far.
+
+def parse_time(time):
+    """
+    time (str): The time string that is given by RT. RT gives UTC time, so it needs to be converted.
+    Return a datetime in the PST timezone. Conversions are remembered, the same times come up again and again.
+    """
+    parsed = _parsed.get(time)
+    if parsed is None:
+        if len(_parsed) > 200000:
+            _parsed.clear()
+        parsed = datetime.strptime(time.strip(), "%Y-%m-%d %H:%M:%S").replace(tzinfo=_utc).astimezone(_pacific)
+        _parsed[time] = parsed
+    return parsed
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread safe mapping that holds at most max_size entries. When full, the least recently used entry is evicted.
+    Keeps count of hits, misses and evictions so the size can be tuned.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key, is_valid=None):
+        """
+        Returns the value of key, or None if it's not in the cache.
+        is_valid (function): Called with the value. If it returns false the entry is dropped and None is returned.
+        """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None and is_valid is not None and not is_valid(value):
+                del self.entries[key]
+                value = None
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def invalidate(self, key):
+        """ Drop the key if it's cached. """
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+    def stats(self):
+        """ Returns a dictionary of the cache's size and counters. """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries),
+                    "max_size": self.max_size,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,199 @@
+import re
+from datetime import datetime
+from datetime import timedelta
+from .store import normalize_date
+
+
+class QueryError(ValueError):
+    """ Raised when a query uses TicketSQL that can't be answered from the cache. """
+
+
+# TicketSQL field (lowercase) -> TicketStore column.
+columns = {"id": "id",
+           "queue": "queue",
+           "created": "created",
+           "lastupdated": "last_updated",
+           "status": "status",
+           "creator": "creator",
+           "cf.{uss_ticket_category}": "category",
+           "cf.{uss_ticket_subcategory}": "subcategory",
+           }
+date_columns = ["created", "last_updated"]
+operators = {"=": "=", "!=": "!=", "<>": "!=", ">": ">", "<": "<", ">=": ">=", "<=": "<="}
+
+token_re = re.compile(r"""\s*(?:
+    (?P<paren>[()])|
+    (?P<string>'[^']*'|"[^"]*")|
+    (?P<op>!=|<>|>=|<=|=|>|<)|
+    (?P<word>CF\.\{[^}]*\}|[A-Za-z_][\w.]*|-?[0-9]+)
+    )""", re.VERBOSE | re.IGNORECASE)
+relative_date_re = re.compile(r"now\s*-\s*([0-9]+)\s*(minute|hour|day|week)s?$", re.IGNORECASE)
+
+
+def tokenize(query):
+    """ Returns a list of (kind, text) tokens. Strings are returned without their quotes. """
+    tokens = []
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        match = token_re.match(query, pos)
+        if not match:
+            raise QueryError("Can't read query at: " + query[pos:])
+        pos = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "string":
+            text = text[1:-1]
+        tokens.append((kind, text))
+    return tokens
+
+
+def parse_date(value, now=None):
+    """
+    value (str): A TicketSQL date such as '2015-09-13' or 'now - 30 days'.
+    Returns the date in the store's "YYYY-MM-DD HH:MM:SS" format.
+    """
+    relative = relative_date_re.match(value.strip())
+    if relative:
+        now = now or datetime.utcnow()
+        amount, unit = int(relative.group(1)), relative.group(2).lower()
+        return (now - timedelta(**{unit + "s": amount})).strftime("%Y-%m-%d %H:%M:%S")
+    date = normalize_date(value)
+    if date is None:
+        try:
+            date = datetime.strptime(value.strip(), "%Y-%m-%d").strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            raise QueryError("Can't read date: " + value)
+    return date
+
+
+class Parser:
+    """
+    Compiles the subset of TicketSQL that we use into a SQL WHERE clause over the TicketStore.
+    Grammar:
+        expr       := term (OR term)*
+        term       := factor (AND factor)*
+        factor     := '(' expr ')' | comparison
+        comparison := FIELD op VALUE | FIELD LIKE VALUE | FIELD IS [NOT] NULL
+    """
+
+    def __init__(self, query, now=None):
+        self.tokens = tokenize(query)
+        self.pos = 0
+        self.now = now
+        self.params = []
+
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+
+    def take(self):
+        token = self.peek()
+        if token[0] is None:
+            raise QueryError("Query ended early")
+        self.pos += 1
+        return token
+
+
+    def is_keyword(self, word):
+        kind, text = self.peek()
+        return kind == "word" and text.upper() == word
+
+
+    def parse(self):
+        sql = self.expr()
+        if self.pos != len(self.tokens):
+            raise QueryError("Unexpected " + self.peek()[1])
+        return sql, self.params
+
+
+    def expr(self):
+        parts = [self.term()]
+        while self.is_keyword("OR"):
+            self.take()
+            parts.append(self.term())
+        return parts[0] if len(parts) == 1 else "(" + " OR ".join(parts) + ")"
+
+
+    def term(self):
+        parts = [self.factor()]
+        while self.is_keyword("AND"):
+            self.take()
+            parts.append(self.factor())
+        return parts[0] if len(parts) == 1 else "(" + " AND ".join(parts) + ")"
+
+
+    def factor(self):
+        if self.peek() == ("paren", "("):
+            self.take()
+            sql = self.expr()
+            if self.take() != ("paren", ")"):
+                raise QueryError("Missing )")
+            return sql
+        return self.comparison()
+
+
+    def comparison(self):
+        kind, field = self.take()
+        if kind != "word" or field.lower() not in columns:
+            raise QueryError("Unsupported field: " + str(field))
+        column = columns[field.lower()]
+
+        if self.is_keyword("IS"):
+            self.take()
+            negate = self.is_keyword("NOT")
+            if negate:
+                self.take()
+            if not self.is_keyword("NULL"):
+                raise QueryError("Expected NULL after IS")
+            self.take()
+            return column + (" IS NOT NULL" if negate else " IS NULL")
+
+        if self.is_keyword("LIKE"):
+            self.take()
+            self.params.append("%" + self.value(column) + "%")
+            return column + " LIKE ?"
+
+        kind, op = self.take()
+        if kind != "op":
+            raise QueryError("Expected an operator after " + field)
+        self.params.append(self.value(column))
+        if column in date_columns or column == "id":
+            return column + " " + operators[op] + " ?"
+        # RT compares strings case insensitively.
+        return column + " " + operators[op] + " ? COLLATE NOCASE"
+
+
+    def value(self, column):
+        kind, text = self.take()
+        if kind not in ["string", "word"]:
+            raise QueryError("Expected a value, got " + text)
+        if column in date_columns:
+            return parse_date(text, self.now)
+        if column == "id":
+            try:
+                return int(text)
+            except ValueError:
+                raise QueryError("Ticket id must be a number: " + text)
+        return text
+
+
+def compile_query(query, now=None):
+    """
+    query (str): TicketSQL query, such as the ones given to RT.rest_search_query.
+    now (datetime): UTC time that relative dates are counted back from. Defaults to the current time.
+    Returns a tuple of (SQL WHERE clause, list of parameters).
+    Raises QueryError if the query uses something outside of the supported subset.
+    """
+    return Parser(query, now).parse()
+
+
+def compile_orderby(orderby):
+    """ orderby (str): RT's orderby, a field with an optional - for descending. Returns a SQL ORDER BY clause. """
+    descending = orderby.startswith("-")
+    field = orderby.lstrip("+-").lower()
+    if field not in columns:
+        raise QueryError("Unsupported orderby: " + orderby)
+    direction = " DESC" if descending else " ASC"
+    return columns[field] + direction + ", id" + direction
@@ -0,0 +1,87 @@
+import numpy as np
+from . import business_calendar
+
+# Response times for many tickets at once. This gives the same numbers as Ticket.get_response_time(),
+# but looks the working time up in the business calendar for arrays of times instead of one datetime at a time.
+
+sec_in_day = business_calendar.sec_in_day
+
+
+def parse_times(times):
+    """
+    times (list): Time strings given by RT, which are in UTC.
+    Returns an int64 array of seconds since epoch.
+    """
+    return np.array([t.strip().replace(' ', 'T') for t in times], dtype='datetime64[s]').astype(np.int64)
+
+
+class CalendarArrays:
+    """ The tables of a BusinessCalendar as arrays, made again when the calendar grows. """
+    def __init__(self, calendar):
+        self.days = len(calendar.opens)
+        self.transition_times = np.array(calendar.transition_times, dtype=np.int64)
+        self.transition_offsets = np.array(calendar.transition_offsets, dtype=np.int64)
+        self.cumulative = np.array(calendar.cumulative, dtype=np.int64)
+        self.opens = np.array(calendar.opens, dtype=np.int64)
+        self.closes = np.array(calendar.closes, dtype=np.int64)
+
+_arrays = {}  # {id of calendar: CalendarArrays}
+
+def calendar_arrays(calendar):
+    arrays = _arrays.get(id(calendar))
+    if arrays is None or arrays.days != len(calendar.opens):
+        arrays = _arrays[id(calendar)] = CalendarArrays(calendar)
+    return arrays
+
+
+def working_seconds(utc_seconds, calendar=None):
+    """ Vectorized BusinessCalendar.working_seconds(). """
+    calendar = calendar or business_calendar.default
+    if len(utc_seconds) and int(utc_seconds.max()) // sec_in_day + 2 - calendar.first_day >= len(calendar.opens):
+        calendar.extend(int(utc_seconds.max()) // sec_in_day + 366)
+    arrays = calendar_arrays(calendar)
+
+    index = np.searchsorted(arrays.transition_times, utc_seconds, side='right') - 1
+    local = utc_seconds + arrays.transition_offsets[np.maximum(index, 0)]
+    day = local // sec_in_day
+    i = day - calendar.first_day
+    before = i < 0
+    i = np.maximum(i, 0)
+    opens = arrays.opens[i]
+    elapsed = np.clip(local - day * sec_in_day - opens, 0, arrays.closes[i] - opens)
+    return np.where(before, 0, arrays.cumulative[i] + elapsed)
+
+
+def time_differences(start_utc, end_utc, calendar=None):
+    """
+    start_utc, end_utc (array): Seconds since epoch, as given by parse_times().
+    Returns an int64 array of the working time in seconds between each start and end.
+    Vectorized version of Ticket.get_time_difference().
+    """
+    return working_seconds(end_utc, calendar) - working_seconds(start_utc, calendar)
+
+
+def response_times(tickets):
+    """
+    tickets (list): Ticket objects.
+    Returns a list with the average response time in seconds of each ticket,
+    or None for tickets without a response (same as Ticket.get_response_time()).
+    """
+    starts = []
+    ends = []
+    owners = []  # Index of the ticket each pair belongs to.
+    for i, ticket in enumerate(tickets):
+        for start, end in ticket.response_pairs():
+            starts.append(start)
+            ends.append(end)
+            owners.append(i)
+
+    if not owners:
+        return [None] * len(tickets)
+
+    differences = time_differences(parse_times(starts), parse_times(ends))
+    owners = np.array(owners)
+    totals = np.zeros(len(tickets), dtype=np.int64)
+    np.add.at(totals, owners, differences)
+    counts = np.bincount(owners, minlength=len(tickets))
+    return [int(total) / int(count) if count else None for total, count in zip(totals, counts)]
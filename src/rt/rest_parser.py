@@ -0,0 +1,140 @@
+"""
+Parser for RT's REST 1.0 responses.
+
+RT answers with "key: value" lines. Values that span multiple lines continue on lines indented
+by the length of the key plus two. Records (histories, search results) are separated by a "--" line,
+and lines starting with # are comments. The first line is the response status, ex: "RT/4.2.12 200 Ok".
+"""
+
+
+def iter_lines(text):
+    """ Yields the lines of text one at a time, without copying the whole text into a list. """
+    start = 0
+    end = text.find("\n")
+    while end != -1:
+        yield text[start:end].rstrip("\r")
+        start = end + 1
+        end = text.find("\n", start)
+    if start < len(text):
+        yield text[start:].rstrip("\r")
+
+
+def _finish_value(lines):
+    if len(lines) == 1:
+        return lines[0].strip()
+    return "\n".join(lines).strip()
+
+
+def iter_records(text):
+    """
+    text (str): Entire text returned from a REST request.
+    Yields each record as a dictionary of {key: value}. Values are stripped strings,
+    multi-line values keep their line breaks with the continuation indentation removed.
+    """
+    record = {}
+    key = None
+    value_lines = None
+    indent = 0
+    for line in iter_lines(text):
+        if not line:
+            if key is not None:
+                value_lines.append("")
+            continue
+
+        first = line[0]
+        if first == " " or first == "\t":
+            # Continuation of the current value.
+            if key is not None:
+                leading = len(line) - len(line.lstrip(" "))
+                value_lines.append(line[min(indent, leading):])
+            continue
+
+        if key is not None:
+            record[key] = _finish_value(value_lines)
+            key = None
+
+        if line == "--":
+            if record:
+                yield record
+                record = {}
+            continue
+        if first == "#" or line.startswith("RT/"):
+            # Comments and the status line.
+            continue
+
+        key, sep, value = line.partition(":")
+        if not sep:
+            key = None
+            continue
+        value_lines = [value]
+        indent = len(key) + 2
+
+    if key is not None:
+        record[key] = _finish_value(value_lines)
+    if record:
+        yield record
+
+
+def parse_properties(text):
+    """
+    text (str): Entire text returned from a ticket/<n>/show request.
+    Returns a dictionary containing the ticket's properties.
+    """
+    return next(iter_records(text), {})
+
+
+def iter_histories(text):
+    """
+    text (str): Entire text returned from a ticket/<n>/history?format=l request.
+    Yields each history as a dictionary. Histories are events that happen in the ticket.
+    """
+    return iter_records(text)
+
+
+def fix_yaml(text):
+    """
+    Fix RT's yaml so that each values can contain special characters.
+    This is done by making each values multiline strings by adding a > character.
+    Returns the fixed yaml's text.
+    Only used by the yaml parsers below, which are kept to check the parser above against.
+    """
+    line_split = text.splitlines()
+
+    # Trim response code.
+    if "RT/4" in line_split[0]:
+        line_split = line_split[1:]
+
+    for i in range(len(line_split)):
+        # Modify the yaml so that each value become a multiline string.
+        # Otherwise special characters like # or : is not escaped properly.
+        if line_split[i] and line_split[i][0] != ' ':
+            line_split[i] = line_split[i].replace(":", ": >\n", 1)
+
+    return "\n".join(line_split)
+
+
+def yaml_parse_properties(text):
+    """ The old yaml based parse_properties(). """
+    import yaml
+    # Trim first two lines.
+    text = text[text.find('\n', text.find('\n')+1)+1:]
+    properties = yaml.safe_load(fix_yaml(text))
+    for k in properties:
+        properties[k] = properties[k].strip()
+    return properties
+
+
+def yaml_parse_histories(text):
+    """ The old yaml based histories parser. Returns a list of histories. """
+    import yaml
+    history_list = fix_yaml(text).split("--\n\n#")
+
+    for i in range(len(history_list)):
+        history = history_list[i]
+        # Trim one line from beginning.
+        history = history[history.find('\n')+1:]
+        history = yaml.safe_load(history)
+        for k in history:
+            history[k] = history[k].strip()
+        history_list[i] = history
+    return history_list
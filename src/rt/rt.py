@@ -1,55 +1,186 @@
 from . import ticket
+from .store import TicketStore, normalize_date
+from .lru import LRUCache
+from . import query as ticket_query
+from . import rest_parser
 import os
+import json
 from datetime import datetime
 import queue
 import threading
 import time
 import re
-import yaml
-import json
 import requests
 import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import metrics
 
 def call_clsinit(cls):
     cls.__clsinit__()
     return cls
 
+
+class lazy_class_attribute:
+    """ Class attribute made by calling f(cls) the first time it is read, so that importing stays quick. """
+    def __init__(self, f):
+        self.f = f
+        self.lock = threading.Lock()
+
+    def __get__(self, instance, owner):
+        with self.lock:
+            value = owner.__dict__[self.f.__name__]
+            if value is self:
+                value = self.f(owner)
+                # Replaces this descriptor, later reads are plain attribute reads.
+                setattr(owner, self.f.__name__, value)
+        return value
+
+
 @call_clsinit
 class RT:
     base_url = "https://support.oit.pdx.edu/NoAuthCAS/REST/1.0/"
     cookies = None  # Not logged in if None.
+    username = None  # Credentials, read on the first login.
+    password = None
+    pool_size = 8  # Keep-alive connections kept open to RT. Should be at least update_workers.
+    request_timeout = 30  # Seconds before a request to RT is given up on.
+    max_retries = 4  # Retries on server errors and timeouts.
+    backoff_factor = 0.5  # Seconds to wait before the first retry, doubled on every retry.
     cache_dir = "../ticket_cache/"
+    keep_history_content = False  # Keep email bodies and other history fields the bot doesn't read in the cache.
+    cache_batch_size = 50  # Amount of fetched tickets written to the store per transaction.
+    checkpoint_interval = 10  # Seconds before fetched tickets are written even if there aren't cache_batch_size of them.
+    ticket_cache_size = 5000  # Amount of parsed tickets kept in memory by get_ticket_from_cache.
+    ticket_cache = None  # LRUCache of {ticket number: (LastUpdated, Ticket)}.
+    search_locally = True  # Answer search_query from the cache instead of asking RT.
+    properties_ttl = 300  # Seconds that looked up ticket properties are served without asking RT again.
+    properties_cache_size = 2000  # Amount of linked tickets whose properties are kept in memory.
+    properties_cache = None  # LRUCache of {ticket number: (time fetched, properties)}.
+    properties_lock = threading.Lock()  # Guards revalidating.
+    revalidating = set()  # Ticket numbers whose properties are being fetched in the background.
+    lookup_pool = ThreadPoolExecutor(max_workers=2)  # Background revalidation of properties.
+    bulk_page_size = 200  # Tickets whose properties are fetched per search request.
     updating = False
+    update_workers = 4  # Amount of tickets fetched at the same time while updating.
+    update_progress_interval = 500  # Report progress every this many tickets.
+    update_plan_ttl = 60  # Seconds that the list of tickets to update is reused for, so !update doesn't search twice.
+    update_plan = None  # (time searched, list of ticket numbers to update)
+    incremental_min_histories = 40  # Cached histories a ticket needs before only its new histories are fetched.
+    incremental_history_limit = 10  # Refetch a ticket's whole history when it has more new transactions than this.
+    # Tickets that should have been tagged with a category and subcategory. The store keeps the ones that weren't.
+    untagged_query = "Created > '2015-09-13' AND Queue = 'uss-helpdesk' AND Status = 'resolved' AND ( CF.{USS_Ticket_Category} IS NULL OR CF.{USS_Ticket_Subcategory} IS NULL )"
+    login_lock = threading.Lock()
+    error_log_lock = threading.Lock()
 
 
     @classmethod
     def __clsinit__(cls):
+        # The environment can point the bot somewhere else, ex: the fake RT server in bench/.
+        cls.base_url = os.environ.get("RT_BASE_URL", cls.base_url)
+        cls.cache_dir = os.environ.get("RT_CACHE_DIR", cls.cache_dir)
+        cls.ticket_cache = LRUCache(cls.ticket_cache_size)
+        cls.properties_cache = LRUCache(cls.properties_cache_size)
+        metrics.register_collector(cls.cache_metrics)
+        # Nothing else happens on import. The store is opened and the session made the first time they are used,
+        # and we log in to RT on the first request that needs it.
+
+
+    @lazy_class_attribute
+    def store(cls):
+        """ TicketStore holding the cached tickets. """
+        return TicketStore(cls.cache_dir + "tickets.db", ticket_query.compile_query(cls.untagged_query),
+                           cls.keep_history_content)
+
+
+    @lazy_class_attribute
+    def session(cls):
+        """ Pooled keep-alive session shared by every request. Starts with the login cookies saved by the last run. """
+        session = cls.create_session()
+        if cls.load_session(session):
+            cls.cookies = session.cookies
+        return session
+
+
+    @classmethod
+    def create_session(cls):
+        """
+        Returns a requests session with a connection pool of pool_size keep-alive connections.
+        The session holds the login cookies, so every request made through it is authenticated.
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=cls.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+    @classmethod
+    def read_credentials(cls):
         try:
             # Read in user/pass.
-            f = open(os.path.dirname(__file__) + "/../../tokens/rt")
-            cls.username, cls.password = tuple(f.read().strip().split(":"))
-            f.close()
+            credentials = os.environ.get("RT_CREDENTIALS")
+            if credentials is None:
+                f = open(os.path.dirname(__file__) + "/../../tokens/rt")
+                credentials = f.read()
+                f.close()
+            cls.username, cls.password = tuple(credentials.strip().split(":"))
         except Exception as e:
             traceback.print_exc()
             print("Something went wrong while reading in username/password.")
             print("Make sure you have a file /tokens/rt with only username:password")
-            exit()
-
-        cls.login()
-        #now.strftime("%Y-%m-%d")
+            raise
 
 
     @classmethod
     def login(cls):
+        """
+        Errors raised:
+        - PermissionError if RT doesn't take the username and password.
+        """
+        if cls.username is None:
+            cls.read_credentials()
         payload = {"user": cls.username, "pass": cls.password}
-        r = requests.post(cls.base_url, data=payload)
+        start = time.time()
+        r = cls.session.post(cls.base_url, data=payload, timeout=cls.request_timeout, allow_redirects=False)
+        metrics.observe("rt_request_seconds", metrics.since(start), endpoint="login")
         if r.status_code == 200:
             print("Logged in successfully as " + cls.username + "!")
             cls.cookies = r.cookies
+            cls.save_session()
         elif r.status_code == 302:
             # 302 means you got redirected to SSO.
             print("Your username or password is incorrect!")
-            exit()
+            raise PermissionError("RT login failed for " + cls.username)
+
+
+    @classmethod
+    def save_session(cls):
+        """ Save the session's cookies in the cache, so that the next run doesn't have to log in again. """
+        cookies = [{"name": c.name, "value": c.value, "domain": c.domain, "path": c.path} for c in cls.session.cookies]
+        path = cls.cache_dir + "session"
+        try:
+            # Only readable by us, the cookies are as good as the password until they expire.
+            fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"base_url": cls.base_url, "cookies": cookies}, f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            traceback.print_exc()
+
+
+    @classmethod
+    def load_session(cls, session):
+        """ Put the cookies saved by save_session() in the session. Returns whether there were any for this RT. """
+        try:
+            with open(cls.cache_dir + "session") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if saved.get("base_url") != cls.base_url or not saved.get("cookies"):
+            return False
+        for c in saved["cookies"]:
+            session.cookies.set(c["name"], c["value"], domain=c["domain"], path=c["path"])
+        return True
 
 
     @classmethod
@@ -58,13 +189,48 @@ class RT:
             return f.read().strip()
 
 
+    @classmethod
+    def set_last_updated(cls, last_updated):
+        """ Write the last_updated file through a temporary file, so that it is never left half written. """
+        tmp_path = cls.cache_dir + "last_updated.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(last_updated)
+        os.replace(tmp_path, cls.cache_dir + "last_updated")
+
+
     @classmethod
     def get_amount_to_update(cls):
+        resumed = cls.store.get_update()
+        if resumed:
+            return len(resumed[1])
+        return len(cls.get_tickets_to_update())
+
+
+    @classmethod
+    def get_tickets_to_update(cls, fresh=False):
+        """
+        Returns the list of ticket numbers updated in RT since last_updated that aren't cached at their latest version.
+        One search gets the LastUpdated of every ticket, which is compared to the cached ticket's.
+        The list is reused for update_plan_ttl seconds unless fresh is True.
+        """
+        if not fresh and cls.update_plan and time.time() - cls.update_plan[0] < cls.update_plan_ttl:
+            return cls.update_plan[1]
+
         last_updated_date = ""
         with open(cls.cache_dir + "last_updated") as f:
             last_updated_date = f.read().strip()
         query = "Queue = 'uss-helpdesk' AND LastUpdated > '" + last_updated_date + "'"
-        return len(cls.rest_search_query(query))
+        records = cls.rest_search_records(query, fields=["LastUpdated"])
+
+        ticket_numbers = [int(record["id"].split("/")[1]) for record in records]
+        cached = cls.store.get_last_updated_many(ticket_numbers)
+        tickets = []
+        for ticket_number, record in zip(ticket_numbers, records):
+            last_updated = normalize_date(record.get("LastUpdated"))
+            if not cached.get(ticket_number) or not last_updated or last_updated > cached[ticket_number]:
+                tickets.append(ticket_number)
+        cls.update_plan = (time.time(), tickets)
+        return tickets
 
 
     @classmethod
@@ -78,35 +244,112 @@ class RT:
         """
         Update the cache since the last time it was updated.
         There needs to be a file in the cache called last_updated.
-        result (Queue): The thread will push the return value into the queue.
+        Tickets are fetched by a pool of update_workers threads sharing the same login cookies.
+        The tickets left to fetch are kept in the store and taken off as each batch is written, so an update that
+        got interrupted picks up where it stopped the next time it runs.
+        result (Queue): The thread will push progress reports into the queue. A report is a dictionary of
+                        {"done", "total", "errors", "rate" (tickets/sec), "finished", "failure"}.
+                        The last report pushed has "finished" set to True. If the update stopped on an error,
+                        its "failure" is the error's message (None otherwise) and the rest is left queued.
         Returns the amount of errors if there are any.
         """
         cls.updating = True
-        last_updated_date = ""
-        with open(cls.cache_dir + "last_updated") as f:
-            last_updated_date = f.read().strip()
-
-        query = "Queue = 'uss-helpdesk' AND LastUpdated > '" + last_updated_date + "'"
-        tickets = cls.rest_search_query(query)
+        total = 0
         error_count = 0
-        print("Updating " + str(len(tickets)) + " tickets!")
-        for ticket in tickets:
-            if not cls.update_cache_ticket(ticket):
-                error_count += 1
-
-        with open(cls.cache_dir + "last_updated", "w") as f:
-            f.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        done = 0
+        failure = None
+        start_time = time.time()
+        def report(finished=False):
+            elapsed = time.time() - start_time
+            rate = done / elapsed if elapsed else 0.0
+            metrics.set_gauge("rt_update_backlog", total - done)
+            metrics.set_gauge("rt_update_rate", rate)
+            result.put({"done": done, "total": total, "errors": error_count,
+                        "rate": rate, "finished": finished, "failure": failure})
+            print("Updated {}/{} tickets ({:.2f} tickets/sec)".format(done, total, rate))
 
-        cls.updating = False
-        result.put(error_count)
-        return
+        try:
+            resumed = cls.store.get_update()
+            if resumed:
+                started, tickets = resumed
+                print("Resuming the update started at " + started)
+            else:
+                tickets = cls.get_tickets_to_update()
+                started = datetime.fromtimestamp(cls.update_plan[0]).strftime("%Y-%m-%d %H:%M:%S")
+                cls.store.start_update(tickets, started)
+            cls.update_plan = None
+            total = len(tickets)
+            print("Updating " + str(total) + " tickets!")
+
+            batch = []
+            finished = []  # Ticket numbers done since the last checkpoint, failed ones included.
+            last_checkpoint = time.time()
+            with ThreadPoolExecutor(max_workers=cls.update_workers) as pool:
+                futures = {}
+
+                def collect(in_flight):
+                    """ Take in fetched tickets, writing them in batches, until at most in_flight are left. """
+                    nonlocal done, error_count, batch, finished, last_checkpoint
+                    while len(futures) > in_flight:
+                        completed, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in completed:
+                            done += 1
+                            content = future.result()
+                            metrics.inc("rt_update_tickets_total", result="error" if content is None else "ok")
+                            # Let go of the future, it holds the ticket's whole content until the update ends otherwise.
+                            finished.append(futures.pop(future))
+                            if content is None:
+                                error_count += 1
+                            else:
+                                batch.append(content)
+                            if len(batch) >= cls.cache_batch_size or time.time() - last_checkpoint > cls.checkpoint_interval:
+                                cls.write_tickets(batch, finished)
+                                batch = []
+                                finished = []
+                                last_checkpoint = time.time()
+                            if done % cls.update_progress_interval == 0 and done != total:
+                                report()
+
+                try:
+                    for i in range(0, total, cls.bulk_page_size):
+                        page = tickets[i:i+cls.bulk_page_size]
+                        try:
+                            properties = cls.rest_get_bulk_properties(page)
+                        except Exception:
+                            # Each worker will fetch its ticket's properties itself.
+                            traceback.print_exc()
+                            properties = {}
+                        for n in page:
+                            futures[pool.submit(cls.fetch_cache_ticket, n, properties.get(n))] = n
+                        # Keep at most one page queued ahead of the workers while the next page's properties are
+                        # fetched, so fetched tickets get written and checkpointed as the update goes.
+                        collect(cls.bulk_page_size)
+                    collect(0)
+                except BaseException:
+                    # Don't fetch the rest of the tickets before giving up.
+                    for future in futures:
+                        future.cancel()
+                    raise
+            cls.write_tickets(batch, finished)
+
+            cls.set_last_updated(started)
+            cls.store.finish_update()
+        except Exception as e:
+            # What wasn't written stays queued, the next update picks it up.
+            traceback.print_exc()
+            failure = "{}: {}".format(type(e).__name__, e)
+            metrics.inc("rt_update_failures_total")
+        finally:
+            cls.updating = False
+            report(finished=True)
+        return error_count
 
 
     @classmethod
     def update_cache(cls):
         """
         Run the update thread.
-        Returns the update thread, which contains return information. The update thread will contain a Queue called results that will automatically be populated by the thread as return information.
+        Returns the update thread, which contains return information. The update thread will contain a Queue called result that will automatically be populated by the thread with progress reports (see _update_cache).
         Returns None if there is already an existing thread.  
         """
         if not cls.updating:
@@ -126,25 +369,59 @@ class RT:
         Updates a single cached ticket, or write one if it doesn't exist.
         Returns whether it succeeds. If it doesn't it will be logged in ticket_cache/error.log
         """
+        content = cls.fetch_cache_ticket(ticket_number)
+        if content is None:
+            return False
+        cls.write_tickets([content])
+        return True
+
+
+    @classmethod
+    def write_tickets(cls, contents, dequeue=()):
+        """
+        contents (list): Ticket contents as given by get_ticket().content.
+        dequeue (list): Ticket numbers the update is done with, taken off its queue in the same transaction.
+        Write the tickets to the cache in one transaction and drop their old parsed versions from memory.
+        """
+        cls.store.put_tickets(contents, dequeue)
+        for content in contents:
+            cls.ticket_cache.invalidate(int(content['id'].split('/')[1]))
+
+
+    @classmethod
+    def get_generation(cls):
+        """
+        Returns the cache's generation, which changes every time cached tickets change, whichever process wrote them.
+        Results computed from the cache are stale once it changes, see TicketStore.generation().
+        """
+        return cls.store.generation()
+
+
+    @classmethod
+    def fetch_cache_ticket(cls, ticket_number, properties=None):
+        """
+        Fetch a ticket's content to be cached.
+        properties (dict): The ticket's properties if they were already fetched.
+        Returns None if it fails, the error will be logged in ticket_cache/error.log
+        """
         try:
             print(str(ticket_number))
-            data = cls.get_ticket(ticket_number).content
-            with open(cls.cache_dir + str(ticket_number) + ".json", "w") as f:
-                json.dump(data, f, indent=2, sort_keys=True)
-                return True
+            return cls.get_updated_ticket(ticket_number, properties).content
         except:
             print("Error on " + str(ticket_number))
-            with open(cls.cache_dir + "error.log", "a") as f:
+            # Worker threads share the log, so keep each entry in one piece.
+            with cls.error_log_lock, open(cls.cache_dir + "error.log", "a") as f:
                 f.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
                 f.write("Ticket: " + str(ticket_number) + "\n")
                 f.write(traceback.format_exc() + "\n")
                 f.write("---------------------\n")
-                return False
+                return None
 
     @classmethod
-    def get_ticket(cls, ticket_number):
+    def get_ticket(cls, ticket_number, properties=None):
         """ 
         Returns a ticket's properties and list of histories as a ticket object.
+        properties (dict): The ticket's properties if they were already fetched (see rest_get_bulk_properties).
 
         Errors raised: 
         - Type error if ticket number is not a number.
@@ -153,23 +430,230 @@ class RT:
         ticket_number = int(ticket_number)
         # Get histories first because it has better ticket validation.
         histories = cls.rest_get_ticket_histories(ticket_number)
-        properties = cls.rest_get_ticket_properties(ticket_number)
+        properties = dict(properties) if properties else cls.rest_get_ticket_properties(ticket_number)
         properties["histories"] = histories
         return ticket.Ticket(properties)
 
 
+    @classmethod
+    def get_updated_ticket(cls, ticket_number, properties=None):
+        """
+        Returns a ticket's properties and list of histories as a ticket object, like get_ticket().
+        A ticket with at least incremental_min_histories cached histories gets the list of its history ids,
+        then only the histories that aren't cached, one request each. The rest come from the cache.
+        That is at least two requests instead of one, but each is short, unlike the whole history with every email.
+        Shorter histories are fetched whole in one request.
+        Falls back to fetching everything if the cached histories don't line up with RT's, a history can't be
+        found, or there are more than incremental_history_limit new histories.
+        """
+        ticket_number = int(ticket_number)
+        cached = cls.store.get_ticket(ticket_number)
+        if not cached or len(cached["histories"]) < cls.incremental_min_histories:
+            return cls.get_ticket(ticket_number, properties)
+
+        try:
+            cached_ids = [int(h["id"]) for h in cached["histories"]]
+            history_ids = cls.rest_get_ticket_history_ids(ticket_number)
+            new_ids = history_ids[len(cached_ids):]
+            if history_ids[:len(cached_ids)] != cached_ids or len(new_ids) > cls.incremental_history_limit:
+                metrics.inc("rt_incremental_fallbacks_total")
+                return cls.get_ticket(ticket_number, properties)
+            histories = cached["histories"] + [cls.rest_get_ticket_history(ticket_number, i) for i in new_ids]
+        except LookupError:
+            # History changed under us, start over.
+            metrics.inc("rt_incremental_fallbacks_total")
+            return cls.get_ticket(ticket_number, properties)
+
+        properties = dict(properties) if properties else cls.rest_get_ticket_properties(ticket_number)
+        properties["histories"] = histories
+        return ticket.Ticket(properties)
+
+
+    @classmethod
+    def get_ticket_properties(cls, ticket_number):
+        """
+        Returns a ticket's properties, without its histories. See get_tickets_properties().
+
+        Errors raised:
+        - LookupError if ticket doesn't exist.
+        """
+        ticket_number = int(ticket_number)
+        properties = cls.get_tickets_properties([ticket_number]).get(ticket_number)
+        if properties is None:
+            raise LookupError("Ticket doesn't exist")
+        return properties
+
+
+    @classmethod
+    def get_tickets_properties(cls, ticket_numbers):
+        """
+        Returns a dictionary of {ticket number: properties} for several tickets. Tickets that couldn't be found are left out.
+        Properties are served from memory or the cache first. If they are older than properties_ttl
+        (or came from the cache) they are still returned, and fetched again from RT in the background.
+        Tickets that were never seen are fetched from RT right away, all of them in one request.
+        """
+        found = {}
+        stale = []
+        missing = []
+        now = time.time()
+        for ticket_number in map(int, ticket_numbers):
+            entry = cls.properties_cache.get(ticket_number)
+            if entry:
+                found[ticket_number] = entry[1]
+                if now - entry[0] > cls.properties_ttl:
+                    stale.append(ticket_number)
+                continue
+
+            properties = cls.store.get_properties(ticket_number)
+            if properties is not None:
+                found[ticket_number] = properties
+                stale.append(ticket_number)
+                continue
+            missing.append(ticket_number)
+
+        if stale:
+            cls.revalidate_properties(stale)
+        if missing:
+            found.update(cls.fetch_tickets_properties(missing))
+        return found
+
+
+    @classmethod
+    def fetch_tickets_properties(cls, ticket_numbers):
+        """ Fetch the tickets' properties from RT and remember them for properties_ttl. """
+        found = cls.rest_get_bulk_properties(ticket_numbers)
+        now = time.time()
+        for ticket_number, properties in found.items():
+            cls.properties_cache.put(ticket_number, (now, properties))
+        return found
+
+
+    @classmethod
+    def revalidate_properties(cls, ticket_numbers):
+        """ Fetch the tickets' properties again in the background, except the ones that already are. """
+        with cls.properties_lock:
+            ticket_numbers = [n for n in ticket_numbers if n not in cls.revalidating]
+            cls.revalidating.update(ticket_numbers)
+        if not ticket_numbers:
+            return
+
+        def revalidate():
+            try:
+                cls.fetch_tickets_properties(ticket_numbers)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with cls.properties_lock:
+                    cls.revalidating.difference_update(ticket_numbers)
+
+        cls.lookup_pool.submit(revalidate)
+
+
     @classmethod
     def get_ticket_from_cache(cls, ticket_number):
         """
         Return the ticket as a ticket object from the cache.
         Returns None if the ticket isn't cached.
+        Parsed tickets are kept in memory for as long as their LastUpdated doesn't change.
         """
-        file_name = cls.cache_dir + str(ticket_number) + ".json"
-        if not os.path.isfile(file_name):
+        ticket_number = int(ticket_number)
+        last_updated = cls.store.get_last_updated(ticket_number)
+        if last_updated is None:
+            cls.ticket_cache.invalidate(ticket_number)
+            return None
+
+        cached = cls.ticket_cache.get(ticket_number, lambda entry: entry[0] == last_updated)
+        if cached:
+            return cached[1]
+
+        start = time.time()
+        content = cls.store.get_ticket(ticket_number)
+        if content is None:
             return None
+        t = ticket.Ticket(content)
+        cls.ticket_cache.put(ticket_number, (last_updated, t))
+        metrics.observe("rt_cache_load_seconds", metrics.since(start))
+        return t
+
+
+    @classmethod
+    def cache_metrics(cls):
+        """ Returns the gauges of the in-memory ticket and properties caches and of the updater, see metrics.register_collector(). """
+        ret = {("rt_ticket_cache_" + k, None): v for k, v in cls.ticket_cache.stats().items()}
+        ret.update({("rt_properties_cache_" + k, None): v for k, v in cls.properties_cache.stats().items()})
+        ret[("rt_updating", None)] = int(cls.updating)
+        ret[("rt_cache_generation", None)] = cls.get_generation()
+        return ret
+
+
+    @classmethod
+    def get_ticket_metrics(cls, ticket_numbers):
+        """
+        Returns a dictionary of {ticket number: metrics} for the given tickets that are cached.
+        See TicketStore.get_metrics() for what the metrics are.
+        """
+        return cls.store.get_metrics(ticket_numbers)
+
+
+    @classmethod
+    def backfill_metrics(cls):
+        """ Compute the metrics of every cached ticket. """
+        count = cls.store.backfill_metrics()
+        return count
+
+
+    @classmethod
+    def compact_cache(cls):
+        """ Rewrite the cache in the compact format, see TicketStore.compact(). Returns the amount of tickets done. """
+        count = cls.store.compact()
+        cls.ticket_cache.clear()
+        return count
+
+
+    @classmethod
+    def get_untagged(cls):
+        """
+        Returns a list of (ticket number, person to blame) of the cached tickets matching untagged_query, newest first.
+        Person is None if nobody responded to or resolved the ticket.
+        """
+        return cls.store.get_untagged(ticket_query.compile_orderby("-created"))
+
+
+    @classmethod
+    def rebuild_untagged(cls):
+        """ Recompute the untagged tickets from the whole cache. Returns the amount of untagged tickets. """
+        count = cls.store.rebuild_untagged()
+        return count
+
+
+    @classmethod
+    def migrate_json_cache(cls):
+        """
+        Import the old cache of one json file per ticket into the store.
+        Returns the amount of tickets imported.
+        """
+        imported = cls.store.import_json_cache(cls.cache_dir)
+        cls.ticket_cache.clear()
+        return imported
+
+
+    @classmethod
+    def search_query(cls, query, orderby="-created", server=None):
+        """
+        Run the given search query and return a list of ticket numbers.
+        The query is answered from the cache's index, so only cached tickets are found.
+        server (bool): Send the query to RT instead. Defaults to not search_locally.
+
+        Errors raised:
+        - query.QueryError if the query can't be answered locally.
+        """
+        if server is None:
+            server = not cls.search_locally
+        if server:
+            return cls.rest_search_query(query, orderby)
+        where, params = ticket_query.compile_query(query)
+        return cls.store.search(where, params, ticket_query.compile_orderby(orderby))
 
-        with open(file_name) as f:
-            return ticket.Ticket(json.load(f))
 
     @classmethod
     def rest_search_query(cls, query, orderby="-created", format_="i"):
@@ -181,6 +665,35 @@ class RT:
         return [int(x.split("/")[1]) for x in text.strip().splitlines()[2:]]
 
 
+    @classmethod
+    def rest_search_records(cls, query, orderby="-created", fields=None):
+        """
+        Run the given search query and return a list of ticket properties as dictionaries, in one request.
+        fields (list): Only get these properties (the id is always included). Defaults to all of them.
+        """
+        url = cls.base_url + "search/ticket?query= " + query + "&orderby=" + orderby + "&format=l"
+        if fields:
+            url += "&fields=" + ",".join(fields)
+        text = cls.rest_get_url(url)
+        return [record for record in rest_parser.iter_records(text) if "id" in record]
+
+
+    @classmethod
+    def rest_get_bulk_properties(cls, ticket_numbers):
+        """
+        ticket_numbers (list of int)
+        Get the properties of many tickets, bulk_page_size tickets per search request.
+        Returns a dictionary of {ticket number: properties}. Tickets that don't exist are left out.
+        """
+        found = {}
+        for i in range(0, len(ticket_numbers), cls.bulk_page_size):
+            page = ticket_numbers[i:i+cls.bulk_page_size]
+            query = " OR ".join("id = " + str(n) for n in page)
+            for record in cls.rest_search_records(query, orderby="+id"):
+                found[int(record["id"].split("/")[1])] = record
+        return found
+
+
     @classmethod
     def rest_get_ticket_properties(cls, ticket_number):
         """
@@ -197,13 +710,7 @@ class RT:
         """
         Return a dictionary containing ticket's properties.
         """
-        # Trim first two lines.
-        text = text[text.find('\n', text.find('\n')+1)+1:]
-        text = cls.fix_yaml(text)
-        properties = yaml.load(text)
-        for k in properties:
-            properties[k] = properties[k].strip()
-        return properties
+        return rest_parser.parse_properties(text)
 
 
     @classmethod
@@ -220,6 +727,34 @@ class RT:
         return histories
 
 
+    @classmethod
+    def rest_get_ticket_history_ids(cls, ticket_number):
+        """
+        ticket_number (int)
+        Returns the list of the ticket's transaction ids (the id of each history), oldest first.
+        Raise errors according to rest_validate_ticket.
+        """
+        ticket_url = cls.base_url + "ticket/" + str(ticket_number) + "/history"
+        text = cls.rest_get_url(ticket_url)
+        cls.rest_validate_ticket_histories(text)
+        # The short format is one "id: description" line per history.
+        return [int(k) for record in rest_parser.iter_records(text) for k in record]
+
+
+    @classmethod
+    def rest_get_ticket_history(cls, ticket_number, transaction_id):
+        """
+        Get a single history of the ticket by its transaction id, as a dictionary.
+        Raise LookupError if RT doesn't give back that history.
+        """
+        ticket_url = cls.base_url + "ticket/" + str(ticket_number) + "/history/id/" + str(transaction_id)
+        text = cls.rest_get_url(ticket_url)
+        history = next(rest_parser.iter_histories(text), None)
+        if not history or history.get("id") != str(transaction_id):
+            raise LookupError("History " + str(transaction_id) + " of ticket " + str(ticket_number) + " not found")
+        return history
+
+
     @classmethod
     def rest_validate_ticket_histories(cls, text):
         """
@@ -244,94 +779,75 @@ class RT:
         """
         text (str): Entire text returned from ticket history request.
         Returns a list of histories. Histories are events that happen in the ticket.
-        Each history is a dictionary.
+        Each history is a dictionary. Use rest_parser.iter_histories() to go through them one at a time.
         """
-        history_list = cls.fix_yaml(text).split("--\n\n#")
-
-        # Parse into yaml.
-        for i in range(len(history_list)):
-            history = history_list[i]
-            # Trim one line from beginning.
-            history = history[history.find('\n')+1:]
-            # Trim whitespaces from the end of each values.
-            history = yaml.load(history)
-            for k in history:
-                history[k] = history[k].strip()
-            history_list[i] = history
-        return history_list
+        return list(rest_parser.iter_histories(text))
 
 
     @classmethod
     def rest_get_url(cls, url):
         """
-        Perform a requests get on the URL. Returns the content's text.
-        This ensures that if the session disconnected, we will reconnect.
-        """
-        if not cls.cookies:
-            cls.login()
-
-        r = requests.get(url, cookies=cls.cookies)
-
-        if r.status_code == 302:
-            # Try logging in again and do the same thing.
-            cls.cookies = None
-            cls.rest_get_url(url)
-        elif r.status_code == 200:
-            return r.text
+        Perform a get on the URL through the pooled session. Returns the content's text.
+        This ensures that if the session disconnected, we will log in again and retry once.
+        Server errors (5xx) and timeouts are retried with exponential backoff.
 
-
-    @classmethod
-    def fix_yaml(cls, text):
-        """
-        Fix RT's yaml so that each values can contain special characters.
-        This is done by making each values multiline strings by adding a > character.
-        Returns the fixed yaml's text.
+        Errors raised:
+        - requests.HTTPError if RT keeps failing or answers with anything other than 200.
+        - requests.Timeout/ConnectionError if we run out of retries.
         """
-        line_split = text.splitlines()
-
-        # Trim response code.
-        if "RT/4" in line_split[0]:
-            line_split = line_split[1:]
-
-        for i in range(len(line_split)):
-            # Modify the yaml so that each value become a multiline string.
-            # Otherwise special characters like # or : is not escaped properly.
-            if line_split[i] and line_split[i][0] != ' ':
-                line_split[i] = line_split[i].replace(":", ": >\n", 1)
+        endpoint = cls.rest_endpoint(url) if metrics.enabled else None
+        session = cls.session  # Made first, it may come with the cookies of the last run.
+        relogged = False
+        attempt = 0
+        while True:
+            if not cls.cookies:
+                with cls.login_lock:
+                    # Another update worker might have logged in while we waited.
+                    if not cls.cookies:
+                        cls.login()
+
+            start = time.time()
+            try:
+                r = session.get(url, timeout=cls.request_timeout, allow_redirects=False)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                metrics.observe("rt_request_seconds", metrics.since(start), endpoint=endpoint)
+                metrics.inc("rt_request_errors_total", endpoint=endpoint, error=type(e).__name__)
+                if attempt >= cls.max_retries:
+                    raise
+                cls.backoff(attempt)
+                attempt += 1
+                continue
+
+            metrics.observe("rt_request_seconds", metrics.since(start), endpoint=endpoint)
+            if r.status_code == 200:
+                return r.text
+            metrics.inc("rt_request_errors_total", endpoint=endpoint, error=r.status_code)
+            if r.status_code == 302 and not relogged:
+                # 302 means the session expired and we got redirected to SSO.
+                # Log in again and do the same thing.
+                cls.cookies = None
+                relogged = True
+                continue
+            if r.status_code >= 500 and attempt < cls.max_retries:
+                cls.backoff(attempt)
+                attempt += 1
+                continue
+            raise requests.HTTPError("RT returned " + str(r.status_code) + " for " + url, response=r)
 
-        return  "\n".join(line_split)
 
+    @classmethod
+    def rest_endpoint(cls, url):
+        """ Returns which REST endpoint the URL is for, ex: "search", "history/id". Used to label metrics. """
+        match = re.search(r"/(search)/ticket|ticket/[^/]+/(show|history)(/id/)?", url)
+        if not match:
+            return "other"
+        if match.group(1):
+            return "search"
+        return match.group(2) + ("/id" if match.group(3) else "")
 
-if __name__ == '__main__':
-    import sys
-
-    if len(sys.argv) > 1:
-        if sys.argv[1] in ["-u", "--update"]:
-            RT.update_cache()
-
-    #s = RT.get_ticket_from_cache(699999)
-    s = RT.get_ticket(699999)
-    print(s)
-
-    #from glob import glob
-    #ticket_files = glob("../ticket_cache/*.yaml")
-    #for file_name in ticket_files:
-    #    print(str(len(ticket_files) - ticket_files.index(file_name)))
-    #    with open(file_name) as f:
-    #        ticket = f.read()
-    #    ticket = yaml.load(ticket)
-    #    with open(file_name[:-5] + ".json", 'w') as f:
-    #        json.dump(ticket, f, indent=2, sort_keys=True)
 
-    #query = "Queue = 'uss-helpdesk' AND Created > 'now - 360 days'"
-    #tickets = rt.rest_search_query(query)
+    @classmethod
+    def backoff(cls, attempt):
+        """ Sleep before retrying a failed request. Waits twice as long on every attempt. """
+        time.sleep(cls.backoff_factor * 2 ** attempt)
 
-    #threads = 4
-    #range_ = int(len(tickets)/threads)
-    #print(range_)
-    #for i in range(threads):
-    #    split = tickets[range_*i : range_*(i+1)]
-    #    if i == threads - 1:
-    #        split = tickets[range_*i:]
-    #    t = threading.Thread(target=save_tickets, args=((split,)))
-    #    t.start()
@@ -1,8 +1,214 @@
 from rt import RT
+from .store import TicketStore
+from .lru import LRUCache
+import metrics
+import multiprocessing
+import threading
+import time
+from types import MappingProxyType
+
+# Each stat is a scan over the metrics of a list of tickets, split in two so it can be sharded across processes:
+# a partial function reduces one shard of tickets to a partial result, and a merge function combines the
+# partial results of the shards, in the order of the shards. Merging in order keeps ties, lists and
+# dictionary order exactly as a single pass over every ticket would have them.
+
+
+def response_time_partial(ticket_numbers, metrics):
+    partial = {"times": [],  # Response times, in ticket order.
+               "slowest": (None, 0),  # (Ticket number, time (in sec))
+               "fastest": (None, 99999999),
+               "no_response_list": [],
+               }
+    for ticket_number in ticket_numbers:
+        # Only get tickets from cache.
+        if ticket_number not in metrics:
+            # Not in cache.
+            continue
+
+        time = metrics[ticket_number]["response_time"]
+        if not time:
+            # No correspondences.
+            if metrics[ticket_number]["no_response"]:
+                partial["no_response_list"].append(ticket_number)
+            continue
+
+        if time > partial["slowest"][1]:
+            partial["slowest"] = (str(ticket_number), time)
+        if time < partial["fastest"][1]:
+            partial["fastest"] = (str(ticket_number), time)
+
+        partial["times"].append(time)
+    return partial
+
+
+def response_time_merge(partials):
+    merged = partials[0]
+    for partial in partials[1:]:
+        # The times are added up once merged, floating point sums depend on the order they are added in.
+        merged["times"] += partial["times"]
+        # Strict comparisons, the earlier ticket wins a tie like it would in one pass.
+        if partial["slowest"][1] > merged["slowest"][1]:
+            merged["slowest"] = partial["slowest"]
+        if partial["fastest"][1] < merged["fastest"][1]:
+            merged["fastest"] = partial["fastest"]
+        merged["no_response_list"] += partial["no_response_list"]
+    return merged
+
+
+def untagged_partial(ticket_numbers, metrics):
+    """
+    Returns ({person: [tickets]}, amount of cached tickets).
+    The first person who responded to a ticket should have tagged it, else the person who resolved it.
+    """
+    untagged_list = {}
+    cached = 0
+    for ticket_number in ticket_numbers:
+        if ticket_number not in metrics:
+            # Not in cache.
+            continue
+        cached += 1
+
+        # If ticket has a response from non user then blame that person.
+        # Else blames the person who resolved it.
+        person = metrics[ticket_number]["first_responder"] or metrics[ticket_number]["resolver"]
+        if person:
+            untagged_list.setdefault(person, []).append(ticket_number)
+    return untagged_list, cached
+
+
+def untagged_merge(partials):
+    untagged_list, cached = partials[0]
+    for partial_list, partial_cached in partials[1:]:
+        for person, ticket_numbers in partial_list.items():
+            untagged_list.setdefault(person, []).extend(ticket_numbers)
+        cached += partial_cached
+    return untagged_list, cached
+
+
+def touches_partial(ticket_numbers, metrics):
+    """ Returns a dictionary of {name: amount of tickets touched}. """
+    touch_dict = {}
+    for ticket_number in ticket_numbers:
+        # Only get tickets from cache.
+        if ticket_number not in metrics:
+            # Not in cache.
+            continue
+        for un in metrics[ticket_number]["touches"]:
+            touch_dict[un] = touch_dict.get(un, 0) + 1
+    return touch_dict
+
+
+def touches_merge(partials):
+    touch_dict = partials[0]
+    for partial in partials[1:]:
+        for un, count in partial.items():
+            touch_dict[un] = touch_dict.get(un, 0) + count
+    return touch_dict
+
+
+def freeze(value):
+    """ Returns a read-only version of a result: lists become tuples and dictionaries read-only views. """
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+worker_store = None  # A worker process' own connection to the store.
+
+def scan_shard(db_path, partial, ticket_numbers):
+    """ Runs in a worker process. Reads the shard's metrics from the store and reduces them with partial. """
+    global worker_store
+    if worker_store is None or worker_store.path != db_path:
+        worker_store = TicketStore(db_path)
+    return partial(ticket_numbers, worker_store.get_metrics(ticket_numbers))
+
 
 class RT_Stat:
-    def __init__(self):
-        pass
+    """
+    Ticket statistics. These only read the metrics computed for each ticket when it was cached,
+    see TicketStore.get_metrics().
+    Scans of at least parallel_threshold tickets are split across a pool of processes if processes is more than 1.
+    Results from the cache are remembered until the cache changes (see RT.get_generation()). They are shared, so they
+    are given read-only, see freeze().
+    """
+    pool = None  # multiprocessing Pool shared by every RT_Stat, started on the first parallel scan.
+    pool_processes = 0
+    pool_lock = threading.Lock()  # Held while the pool is started, replaced or submitted to.
+    parallel_threshold = 5000  # Fewer tickets than this are quicker to scan in this process.
+    results = LRUCache(64)  # {(stat, arguments): (RT.get_generation(), time computed, result)}, shared by every RT_Stat.
+    relative_max_age = 600  # Seconds that results over the last N days are kept, as the window moves with time.
+
+    def __init__(self, server=None, processes=1):
+        """
+        server (bool): Find tickets by asking RT instead of searching the cache.
+                       Defaults to RT.search_locally.
+        processes (int): Amount of processes to scan tickets with.
+        """
+        self.server = server
+        self.processes = processes
+
+
+    def cached(self, f, *args, relative=False):
+        """
+        Returns f(*args) made read-only by freeze(), remembered for as long as the cache doesn't change.
+        relative (bool): The result depends on the current time, it is only kept for relative_max_age seconds.
+        Results found by asking RT aren't remembered, the cache changing says nothing about them.
+        """
+        server = self.server if self.server is not None else not RT.search_locally
+        if server:
+            return f(*args)
+        key = (f.__name__,) + args
+        generation = RT.get_generation()  # Read before computing, so that a result is never newer than its generation.
+        now = time.time()
+        entry = self.results.get(key, lambda e: e[0] == generation and (not relative or now - e[1] < self.relative_max_age))
+        if entry is not None:
+            metrics.inc("rt_stat_results_total", result="hit")
+            return entry[2]
+        metrics.inc("rt_stat_results_total", result="miss")
+        result = freeze(f(*args))
+        self.results.put(key, (generation, now, result))
+        return result
+
+
+    @classmethod
+    def result_cache_metrics(cls):
+        """ Gauges of the results cache, see metrics.register_collector(). """
+        return {("rt_stat_results_" + k, None): v for k, v in cls.results.stats().items()}
+
+
+    def scan(self, partial, merge, ticket_numbers):
+        """
+        Reduce the tickets' metrics with partial, in one go or in shards across the process pool.
+        Returns merge() of the partial results.
+        """
+        if self.processes <= 1 or len(ticket_numbers) < self.parallel_threshold:
+            return merge([partial(ticket_numbers, RT.get_ticket_metrics(ticket_numbers))])
+
+        shard_size = -(-len(ticket_numbers) // self.processes)
+        with self.pool_lock:
+            pool = self.get_pool(self.processes)
+            shards = [pool.apply_async(scan_shard, (RT.store.path, partial, ticket_numbers[i:i+shard_size]))
+                      for i in range(0, len(ticket_numbers), shard_size)]
+        return merge([shard.get() for shard in shards])
+
+
+    @classmethod
+    def get_pool(cls, processes):
+        """ Returns the process pool, started with the given amount of processes. Call with pool_lock held. """
+        if cls.pool is None or cls.pool_processes != processes:
+            if cls.pool is not None:
+                # Shards already submitted to the old pool still run, then its workers exit.
+                cls.pool.close()
+            # The bot has threads running by now, and a forked worker would get a copy of any lock they held.
+            # Workers come from a fresh process instead, and open their own store (see scan_shard).
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            # A Pool from the context rather than ProcessPoolExecutor, which only takes a context from Python 3.7.
+            cls.pool = context.Pool(processes)
+            cls.pool_processes = processes
+        return cls.pool
 
 
     def get_average_response_time(self, days_ago=30):
@@ -10,122 +216,70 @@ class RT_Stat:
         Get the average response time in seconds of tickets queried from given days ago.
         Returns: average time, slowest ticket (ticket_number, time), fastest ticket, (no response amount, ticket total), list of no response tickets.
         """
+        return self.cached(self.compute_average_response_time, int(days_ago), relative=True)
+
+
+    def compute_average_response_time(self, days_ago):
         query = "Queue = 'uss-helpdesk' AND Created > 'now - " + str(days_ago) + " days'"
-        ticket_numbers = RT.rest_search_query(query)
-
-        sum_ = 0
-        ticket_count = len(ticket_numbers)
-
-        slowest_ticket = (None, 0)  # (Ticket number, time (in sec))
-        fastest_ticket = (None, 99999999)
-        no_response = 0
-        no_response_list = []
-        for ticket_number in ticket_numbers:
-            ticket = RT.get_ticket_from_cache(ticket_number)
-
-            # Only get tickets from cache.
-            if ticket == None:
-                # Not in cache.
-                ticket_count -= 1
-                continue
-
-            time = ticket.get_response_time()
-            if not time:
-                # No correspondences.
-                if ticket.status != 'resolved' and \
-                   ticket.status != 'rejected' and \
-                   not ticket.is_qthelper:
-                    # Instant resolves and rejected tickets don't count as no_response.
-                    no_response += 1
-                    no_response_list.append(ticket_number)
-                ticket_count -= 1
-                continue
-
-            if time > slowest_ticket[1]:
-                slowest_ticket = (ticket.number, time)
-            if time < fastest_ticket[1]:
-                fastest_ticket = (ticket.number, time)
-
-            sum_ += time
-        if ticket_count == 0:
+        ticket_numbers = RT.search_query(query, server=self.server)
+
+        result = self.scan(response_time_partial, response_time_merge, ticket_numbers)
+        times = result["times"]
+        if not times:
             return None
-        return sum_ / ticket_count, slowest_ticket, fastest_ticket, (no_response, len(ticket_numbers)), no_response_list
+        no_response_list = result["no_response_list"]
+        return (sum(times) / len(times), result["slowest"], result["fastest"],
+                (len(no_response_list), len(ticket_numbers)), no_response_list)
 
     def untag_blame(self):
         """
-        Returns dict of {person: [tickets], ...}, where person is who should have tagged it. 
-        On the basis that the first person who respond to a ticket should tag it. 
+        Returns dict of {person: [tickets], ...}, where person is who should have tagged it.
+        On the basis that the first person who respond to a ticket should tag it.
         If there's no response then the person who resolved it should have tagged it.
         Returns None if there is no untagged ticket.
+        Reads the untagged tickets kept by the store, unless tickets are searched for on RT.
         """
-        query = "Created > '2015-09-13' AND Queue = 'uss-helpdesk' AND Status = 'resolved' AND ( CF.{USS_Ticket_Category} IS NULL OR CF.{USS_Ticket_Subcategory} IS NULL )"
-        ticket_numbers = RT.rest_search_query(query)
+        return self.cached(self.compute_untag_blame)
 
-        ticket_count = len(ticket_numbers)
 
-        untagged_list = {}
+    def compute_untag_blame(self):
+        server = self.server if self.server is not None else not RT.search_locally
+        if server:
+            ticket_numbers = RT.search_query(RT.untagged_query, server=True)
+            untagged_list, cached = self.scan(untagged_partial, untagged_merge, ticket_numbers)
+            if cached == 0:
+                return None
+            return untagged_list
 
-        def add_untagged(person, ticket_number):
-            """
-            Add the ticket number to the person's list.
-            person (str): name of the blamed person.
-            """
-            if person in untagged_list:
-                untagged_list[person].append(ticket_number)
-            else:
-                untagged_list[person] = [ticket_number]
-
-        for ticket_number in ticket_numbers:
-            ticket = RT.get_ticket_from_cache(ticket_number)
-
-            if ticket == None:
-                # Not in cache.
-                ticket_count -= 1
-                continue
-
-            if ticket.first_non_user_corr:
-                # If ticket has a response from non user then blame that person.
-                add_untagged(ticket.first_non_user_corr['Creator'], ticket_number)
-            elif len(ticket.resolves) and 'Creator' in ticket.resolves[0]:
-                # Else blames the person who resolved it.
-                add_untagged(ticket.resolves[0]['Creator'], ticket_number)
-
-        if ticket_count == 0:
+        untagged = RT.get_untagged()
+        if not untagged:
             return None
-
+        untagged_list = {}
+        for ticket_number, person in untagged:
+            if person:
+                untagged_list.setdefault(person, []).append(ticket_number)
         return untagged_list
 
 
     def ticket_touches(self, days_ago=30, username=None):
-        """ 
+        """
         Count the ticket touches. If username is not provided, will include everyone in the result.
-        Returns a dictionary of {name: count}. If username is provided, will only return count.
+        Returns a read-only dictionary of {name: count}. If username is provided, will only return count.
         """
-        query = "Queue = 'uss-helpdesk' AND LastUpdated > 'now - " + str(days_ago) + " days'"
-        ticket_numbers = RT.rest_search_query(query)
-        
-        touch_dict = {}
-        for ticket_number in ticket_numbers:
-            ticket = RT.get_ticket_from_cache(ticket_number)
-
-            # Only get tickets from cache.
-            if ticket == None:
-                # Not in cache.
-                continue
-
-            # This also handles case one username case.
-            # Definitely slower than handling that separately, but this is cleaner.
-            # If performance is necessary, can add separate check for one username case.
-            for un in ticket.touches:
-                if un not in touch_dict:
-                    touch_dict[un] = 0
-                touch_dict[un] += 1
-                        
+        # Everyone's touches are counted either way, so one result serves every username.
+        touch_dict = self.cached(self.compute_ticket_touches, int(days_ago), relative=True)
         if username:
             return touch_dict[username]
-        return touch_dict 
-                
+        return touch_dict
+
+
+    def compute_ticket_touches(self, days_ago):
+        query = "Queue = 'uss-helpdesk' AND LastUpdated > 'now - " + str(days_ago) + " days'"
+        ticket_numbers = RT.search_query(query, server=self.server)
+        return self.scan(touches_partial, touches_merge, ticket_numbers)
+
 
+metrics.register_collector(RT_Stat.result_cache_metrics)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,459 @@
+import json
+import sqlite3
+import threading
+import zlib
+from datetime import datetime
+from .ticket import Ticket
+
+
+def normalize_date(value):
+    """
+    value (str): A date given by RT. Ticket properties look like "Mon Dec 11 16:33:18 2017"
+                 while histories look like "2017-12-11 16:33:18".
+    Returns the date as "YYYY-MM-DD HH:MM:SS" so that dates sort as strings.
+    Returns None if the date is not set.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    for time_format in ("%Y-%m-%d %H:%M:%S", "%a %b %d %H:%M:%S %Y"):
+        try:
+            return datetime.strptime(value, time_format).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            pass
+    return None
+
+
+# History fields read by the stats, the linker and the incremental updater. The rest, mostly email bodies in Content,
+# is dropped when a ticket is written unless the store keeps content.
+history_fields = ["id", "Ticket", "Type", "Field", "OldValue", "NewValue", "Description", "Creator", "Created"]
+compress_threshold = 512  # Encoded values at least this long are compressed.
+
+
+def encode(value):
+    """ Returns the value as compact json, zlib compressed into bytes if it is long enough to be worth it. """
+    text = json.dumps(value, separators=(",", ":"))
+    if len(text) < compress_threshold:
+        return text
+    return zlib.compress(text.encode("utf-8"))
+
+
+def decode(value):
+    """ Reads back what encode() wrote, or json text written before values were compressed. """
+    if isinstance(value, bytes):
+        value = zlib.decompress(value).decode("utf-8")
+    return json.loads(value)
+
+
+def project_history(history):
+    """ Returns the history with only history_fields. """
+    return {k: history[k] for k in history_fields if k in history}
+
+
+def ticket_metrics(contents):
+    """
+    contents (list): Ticket contents as given by RT.get_ticket().content.
+    Returns the metrics rows of the tickets, everything the stats commands need to know about a ticket:
+    (ticket_id, response_time, no_response, touches, first_responder, resolver, tagged)
+    """
+    # numpy is only loaded once tickets get written, not on import.
+    from .response_time import response_times
+    tickets = [Ticket(content) for content in contents]
+    rows = []
+    for ticket, time in zip(tickets, response_times(tickets)):
+        # Instant resolves, rejected tickets and qthelper tickets don't count as no response.
+        no_response = not time and ticket.status not in ['resolved', 'rejected'] and not ticket.is_qthelper
+        resolver = ticket.resolves[0].get('Creator') if ticket.resolves else None
+        rows.append((int(ticket.number),
+                     time,
+                     no_response,
+                     json.dumps(ticket.touches),
+                     ticket.first_non_user_corr['Creator'] if ticket.first_non_user_corr else None,
+                     resolver,
+                     bool(ticket.tag and ticket.subtag)))
+    return rows
+
+
+class TicketStore:
+    """
+    Single file SQLite store for cached tickets.
+    Ticket properties are kept in the tickets table, with the fields we search on pulled out into
+    indexed columns. Each history of a ticket is a row in the histories table, keyed by its transaction id.
+    The metrics table holds what the stats commands need from each ticket, computed when the ticket is written.
+    The untagged table holds the tickets that should have been tagged but weren't, with who to blame for it.
+    The update_queue and update_state tables hold the tickets left to fetch by an update, so it can resume after a restart.
+    The generation table holds a counter bumped by every write that changes what the stats read, in the same
+    transaction, so that every process using the database can tell when its results went stale.
+    Properties and histories are stored with encode(), histories only keep history_fields unless keep_content is set.
+    Connections are per thread, writes are serialized and done in batched transactions.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY,
+            queue TEXT,
+            created TEXT,
+            last_updated TEXT,
+            status TEXT,
+            creator TEXT,
+            category TEXT,
+            subcategory TEXT,
+            properties TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tickets_created ON tickets (created);
+        CREATE INDEX IF NOT EXISTS tickets_last_updated ON tickets (last_updated);
+        CREATE INDEX IF NOT EXISTS tickets_status ON tickets (status);
+        CREATE INDEX IF NOT EXISTS tickets_creator ON tickets (creator);
+        CREATE INDEX IF NOT EXISTS tickets_category ON tickets (category, subcategory);
+
+        CREATE TABLE IF NOT EXISTS histories (
+            ticket_id INTEGER NOT NULL,
+            id INTEGER NOT NULL,
+            history TEXT NOT NULL,
+            PRIMARY KEY (ticket_id, id)
+        );
+
+        CREATE TABLE IF NOT EXISTS metrics (
+            ticket_id INTEGER PRIMARY KEY,
+            response_time REAL,
+            no_response INTEGER NOT NULL,
+            touches TEXT NOT NULL,
+            first_responder TEXT,
+            resolver TEXT,
+            tagged INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS untagged (
+            ticket_id INTEGER PRIMARY KEY,
+            person TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS update_queue (
+            ticket_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS update_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS generation (
+            value INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path, untagged_where=None, keep_content=False):
+        """
+        path (str): The database file. It is created if it doesn't exist.
+        untagged_where ((str, list)): Compiled query of the tickets that should be tagged, see query.compile_query().
+                                      The untagged table is only kept up to date if it is given.
+        keep_content (bool): Store histories whole, email bodies included.
+        """
+        self.path = path
+        self.keep_content = keep_content
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self.untagged_where = untagged_where
+        conn = self.connection()
+        new_untagged = not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'untagged'").fetchone()
+        conn.executescript(self.schema)
+        with conn:
+            conn.execute("INSERT INTO generation SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM generation)")
+        if new_untagged and untagged_where:
+            # Tickets cached before the untagged table existed.
+            self.rebuild_untagged()
+
+
+    def connection(self):
+        """ Returns the calling thread's connection to the database. """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            # WAL lets the stats commands read while the updater is writing.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+
+    def put_tickets(self, contents, dequeue=()):
+        """
+        contents (list): Ticket contents as given by RT.get_ticket().content.
+        dequeue (list): Ticket numbers to take off the update queue, see start_update().
+        Writes all the tickets and their metrics in one transaction, replacing the ones that were already stored.
+        """
+        rows = ticket_metrics(contents)
+        with self.write_lock:
+            conn = self.connection()
+            with conn:
+                for content in contents:
+                    self._put_ticket(conn, content)
+                self._put_metrics(conn, rows)
+                self._put_untagged(conn, [row[0] for row in rows])
+                conn.executemany("DELETE FROM update_queue WHERE ticket_id = ?", [(int(n),) for n in dequeue])
+                if contents:
+                    self._bump_generation(conn)
+
+
+    def start_update(self, ticket_numbers, started):
+        """
+        Remember an update in the database, so that it can be resumed if it gets interrupted.
+        ticket_numbers (list): Tickets to fetch. They are taken off the queue as they are written by put_tickets().
+        started (str): When the tickets to update were searched for, the cache is up to date as of then once they are done.
+        """
+        with self.write_lock:
+            conn = self.connection()
+            with conn:
+                conn.execute("DELETE FROM update_queue")
+                conn.executemany("INSERT OR IGNORE INTO update_queue VALUES (?)", [(int(n),) for n in ticket_numbers])
+                conn.execute("INSERT OR REPLACE INTO update_state VALUES ('started', ?)", (started,))
+
+
+    def get_update(self):
+        """ Returns (started, list of ticket numbers left) of the update in progress, or None if there isn't one. """
+        conn = self.connection()
+        row = conn.execute("SELECT value FROM update_state WHERE key = 'started'").fetchone()
+        if row is None:
+            return None
+        return row[0], [n for (n,) in conn.execute("SELECT ticket_id FROM update_queue")]
+
+
+    def finish_update(self):
+        with self.write_lock:
+            conn = self.connection()
+            with conn:
+                conn.execute("DELETE FROM update_queue")
+                conn.execute("DELETE FROM update_state")
+
+
+    def _put_ticket(self, conn, content):
+        properties = dict(content)
+        histories = properties.pop("histories", [])
+        ticket_id = int(properties["id"].split("/")[1])
+
+        conn.execute("INSERT OR REPLACE INTO tickets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (ticket_id,
+                      properties.get("Queue"),
+                      normalize_date(properties.get("Created")),
+                      normalize_date(properties.get("LastUpdated")),
+                      properties.get("Status"),
+                      properties.get("Creator"),
+                      properties.get("CF.{USS_Ticket_Category}") or None,
+                      properties.get("CF.{USS_Ticket_Subcategory}") or None,
+                      encode(properties)))
+
+        conn.execute("DELETE FROM histories WHERE ticket_id = ?", (ticket_id,))
+        conn.executemany("INSERT OR REPLACE INTO histories VALUES (?, ?, ?)",
+                         [(ticket_id, int(h["id"]), self.encode_history(h)) for h in histories])
+
+
+    def encode_history(self, history):
+        if not self.keep_content:
+            history = project_history(history)
+        return encode(history)
+
+
+    def _bump_generation(self, conn):
+        conn.execute("UPDATE generation SET value = value + 1")
+
+
+    def generation(self):
+        """ Returns the counter that every write to tickets, metrics or untagged bumps. """
+        return self.connection().execute("SELECT value FROM generation").fetchone()[0]
+
+
+    def _put_metrics(self, conn, rows):
+        conn.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+    def _put_untagged(self, conn, ticket_numbers=None):
+        """
+        Recompute the untagged rows of the given tickets from the tickets and metrics tables, or of every ticket if None.
+        The first person who responded to a ticket should have tagged it, else the person who resolved it.
+        """
+        if not self.untagged_where:
+            return
+        where, params = self.untagged_where
+        sql = ("INSERT INTO untagged SELECT id, (SELECT COALESCE(NULLIF(first_responder, ''), NULLIF(resolver, '')) "
+               "FROM metrics WHERE ticket_id = tickets.id) FROM tickets WHERE (" + where + ")")
+        if ticket_numbers is None:
+            conn.execute("DELETE FROM untagged")
+            conn.execute(sql, params)
+            return
+        chunk = 500
+        for i in range(0, len(ticket_numbers), chunk):
+            numbers = ticket_numbers[i:i+chunk]
+            in_numbers = "(" + ", ".join("?" * len(numbers)) + ")"
+            conn.execute("DELETE FROM untagged WHERE ticket_id IN " + in_numbers, numbers)
+            conn.execute(sql + " AND id IN " + in_numbers, list(params) + numbers)
+
+
+    def rebuild_untagged(self):
+        """ Recompute the whole untagged table. Returns the amount of untagged tickets. """
+        with self.write_lock:
+            conn = self.connection()
+            with conn:
+                self._put_untagged(conn)
+                self._bump_generation(conn)
+        return self.connection().execute("SELECT COUNT(*) FROM untagged").fetchone()[0]
+
+
+    def get_untagged(self, order):
+        """
+        order (str): SQL ORDER BY clause on the tickets table, see query.compile_orderby().
+        Returns a list of (ticket number, person to blame) of the untagged tickets. Person is None if nobody touched it.
+        """
+        sql = "SELECT ticket_id, person FROM untagged JOIN tickets ON tickets.id = untagged.ticket_id ORDER BY " + order
+        return self.connection().execute(sql).fetchall()
+
+
+    def get_ticket(self, ticket_number):
+        """
+        Returns the ticket's content (properties with its list of histories) as a dictionary,
+        the same way it was given to put_tickets().
+        Returns None if the ticket isn't stored.
+        """
+        conn = self.connection()
+        row = conn.execute("SELECT properties FROM tickets WHERE id = ?", (int(ticket_number),)).fetchone()
+        if row is None:
+            return None
+        content = decode(row[0])
+        content["histories"] = [decode(h) for (h,) in
+                                conn.execute("SELECT history FROM histories WHERE ticket_id = ? ORDER BY id",
+                                             (int(ticket_number),))]
+        return content
+
+
+    def search(self, where, params, order):
+        """
+        where, params (str, list): A compiled query, see query.compile_query().
+        order (str): SQL ORDER BY clause, see query.compile_orderby().
+        Returns the list of matching ticket numbers.
+        """
+        sql = "SELECT id FROM tickets WHERE " + where + " ORDER BY " + order
+        return [ticket_id for (ticket_id,) in self.connection().execute(sql, params)]
+
+
+    def _select_in(self, sql, ticket_numbers):
+        """
+        sql (str): Query with a single "IN (%s)" for the ticket numbers.
+        Yields the rows for all the ticket numbers, a chunk at a time to stay under SQLite's limit of parameters.
+        """
+        ticket_numbers = [int(n) for n in ticket_numbers]
+        conn = self.connection()
+        chunk = 500
+        for i in range(0, len(ticket_numbers), chunk):
+            numbers = ticket_numbers[i:i+chunk]
+            for row in conn.execute(sql % ", ".join("?" * len(numbers)), numbers):
+                yield row
+
+
+    def get_metrics(self, ticket_numbers):
+        """
+        Returns a dictionary of {ticket number: metrics} for the given tickets that are stored.
+        Metrics is a dictionary with the keys response_time, no_response, touches, first_responder, resolver and tagged.
+        """
+        ret = {}
+        for row in self._select_in("SELECT * FROM metrics WHERE ticket_id IN (%s)", ticket_numbers):
+            ret[row[0]] = {"response_time": row[1],
+                           "no_response": bool(row[2]),
+                           "touches": json.loads(row[3]),
+                           "first_responder": row[4],
+                           "resolver": row[5],
+                           "tagged": bool(row[6])}
+        return ret
+
+
+    def get_last_updated_many(self, ticket_numbers):
+        """ Returns a dictionary of {ticket number: LastUpdated} for the given tickets that are stored. See get_last_updated(). """
+        return {ticket_id: last_updated or "" for ticket_id, last_updated in
+                self._select_in("SELECT id, last_updated FROM tickets WHERE id IN (%s)", ticket_numbers)}
+
+
+    def backfill_metrics(self, batch_size=500):
+        """
+        Compute the metrics of every stored ticket again. Used for tickets stored before metrics existed.
+        Returns the amount of tickets done.
+        """
+        ticket_numbers = [n for (n,) in self.connection().execute("SELECT id FROM tickets")]
+        for i in range(0, len(ticket_numbers), batch_size):
+            rows = ticket_metrics([self.get_ticket(n) for n in ticket_numbers[i:i+batch_size]])
+            with self.write_lock:
+                conn = self.connection()
+                with conn:
+                    self._put_metrics(conn, rows)
+                    self._put_untagged(conn, [row[0] for row in rows])
+                    self._bump_generation(conn)
+            print("Computed metrics for {}/{} tickets".format(min(i + batch_size, len(ticket_numbers)), len(ticket_numbers)))
+        return len(ticket_numbers)
+
+
+    def get_properties(self, ticket_number):
+        """ Returns the ticket's properties without its histories, or None if the ticket isn't stored. """
+        row = self.connection().execute("SELECT properties FROM tickets WHERE id = ?", (int(ticket_number),)).fetchone()
+        if row is None:
+            return None
+        return decode(row[0])
+
+
+    def get_last_updated(self, ticket_number):
+        """
+        Returns the stored LastUpdated of the ticket as "YYYY-MM-DD HH:MM:SS", or "" if RT didn't give one.
+        Returns None if the ticket isn't stored.
+        """
+        row = self.connection().execute("SELECT last_updated FROM tickets WHERE id = ?", (int(ticket_number),)).fetchone()
+        if row is None:
+            return None
+        return row[0] or ""
+
+
+    def compact(self, batch_size=500):
+        """
+        Write every stored ticket again with encode() and the history projection, then shrink the database file.
+        Used on databases written before tickets were compacted, or after turning keep_content off.
+        Returns the amount of tickets done.
+        """
+        ticket_numbers = [n for (n,) in self.connection().execute("SELECT id FROM tickets")]
+        for i in range(0, len(ticket_numbers), batch_size):
+            numbers = ticket_numbers[i:i+batch_size]
+            properties = list(self._select_in("SELECT id, properties FROM tickets WHERE id IN (%s)", numbers))
+            histories = list(self._select_in("SELECT ticket_id, id, history FROM histories WHERE ticket_id IN (%s)", numbers))
+            with self.write_lock:
+                conn = self.connection()
+                with conn:
+                    conn.executemany("UPDATE tickets SET properties = ? WHERE id = ?",
+                                     [(encode(decode(value)), ticket_id) for ticket_id, value in properties])
+                    conn.executemany("UPDATE histories SET history = ? WHERE ticket_id = ? AND id = ?",
+                                     [(self.encode_history(decode(value)), ticket_id, history_id)
+                                      for ticket_id, history_id, value in histories])
+            print("Compacted {}/{} tickets".format(min(i + batch_size, len(ticket_numbers)), len(ticket_numbers)))
+        with self.write_lock:
+            self.connection().execute("VACUUM")
+        return len(ticket_numbers)
+
+
+    def import_json_cache(self, cache_dir, batch_size=500):
+        """
+        One-shot migration of the old cache, where each ticket was written to cache_dir/<number>.json.
+        The json files are left alone, they can be deleted once the import looks good.
+        Returns the amount of tickets imported.
+        """
+        from glob import glob
+        file_names = glob(cache_dir + "*.json")
+        batch = []
+        imported = 0
+        for file_name in file_names:
+            try:
+                with open(file_name) as f:
+                    batch.append(json.load(f))
+            except ValueError:
+                # Truncated or broken file, the updater will fetch this ticket again.
+                print("Skipping broken file " + file_name)
+                continue
+            if len(batch) >= batch_size:
+                self.put_tickets(batch)
+                imported += len(batch)
+                batch = []
+                print("Imported {}/{} tickets".format(imported, len(file_names)))
+        self.put_tickets(batch)
+        imported += len(batch)
+        print("Imported {}/{} tickets".format(imported, len(file_names)))
+        return imported
@@ -1,13 +1,14 @@
-import pytz
-from datetime import datetime
-from datetime import timedelta
+from . import business_calendar
 
 class Ticket:
     """
     Contains shortcut variables to data on a single ticket.
-    Beware that as more shortcut variables get added, this class can become a performance choke point
-    since every ticket gets constructed into this object.
+    Every ticket gets constructed into this object, so the derived shortcuts (correspondences, touches, ...)
+    are only computed the first time they're used and then kept.
     """
+    __slots__ = ["content", "status", "histories", "number", "user", "is_qthelper", "tag", "subtag",
+                 "_correspondences", "_first_non_user_corr", "_touches", "_resolves"]
+    _unset = object()  # Marks a derived shortcut that hasn't been computed yet.
 
 
     def __init__(self, content):
@@ -27,16 +28,44 @@ class Ticket:
         self.tag = self.content['CF.{USS_Ticket_Category}'] if 'CF.{USS_Ticket_Category}' in self.content else None
         self.subtag = self.content['CF.{USS_Ticket_Subcategory}'] if 'CF.{USS_Ticket_Subcategory}' in self.content else None
 
-        self.correspondences = self._get_correspondences()
-        self.first_non_user_corr = self._first_corr_from_non_user()
-        self.last_correspondence = None if not self.correspondences \
-                                        else self.correspondences[len(self.correspondences) - 1]
+        self._correspondences = Ticket._unset
+        self._first_non_user_corr = Ticket._unset
+        self._touches = Ticket._unset
+        self._resolves = Ticket._unset
 
-        self.touches = self._get_touches()  # List of people that touched this ticket.
 
+    @property
+    def correspondences(self):
+        if self._correspondences is Ticket._unset:
+            self._correspondences = self._get_correspondences()
+        return self._correspondences
 
-        self.resolves = self._get_resolves()
 
+    @property
+    def first_non_user_corr(self):
+        if self._first_non_user_corr is Ticket._unset:
+            self._first_non_user_corr = self._first_corr_from_non_user()
+        return self._first_non_user_corr
+
+
+    @property
+    def last_correspondence(self):
+        return self.correspondences[-1] if self.correspondences else None
+
+
+    @property
+    def touches(self):
+        """ List of people that touched this ticket. """
+        if self._touches is Ticket._unset:
+            self._touches = self._get_touches()
+        return self._touches
+
+
+    @property
+    def resolves(self):
+        if self._resolves is Ticket._unset:
+            self._resolves = self._get_resolves()
+        return self._resolves
 
 
     def _get_correspondences(self):
@@ -64,17 +93,14 @@ class Ticket:
         Return a list of people that have touched this ticket.
         Filters out RT_System as well as users with actual email (aka not from OIT).
         """
-        ret = []
+        ret = {}  # Used as an ordered set.
         for h in self.histories:
             if '@' in h['Creator'] or 'RT_System' in h['Creator']:
                 # Filter out RT_System and emails (assuming no OIT usernames include '@'.
                 continue
-            if h['Creator'] not in ret:
-                ret.append(h['Creator'])
-        return ret
-            
+            ret[h['Creator']] = None
+        return list(ret)
 
-        
 
     def _get_resolves(self):
         """
@@ -85,64 +111,48 @@ class Ticket:
         return [h for h in self.histories if h['Type'].strip() == 'Status' and h['NewValue'] == 'resolved']
 
 
-    def get_response_time(self):
+    def response_pairs(self):
         """
-        Return the average response time of the ticket in seconds.
-        This looks for user correspondence and times the follow-up correspondence.
-        Return None if ticket has no correspondence from non-users.
+        Returns a list of (start, end) time strings, one for each time a user waited on a response.
+        This looks for user correspondence and pairs it with the follow-up correspondence.
         """
-        if not self.correspondences:
-            return None
-
         corr_list = self.correspondences  # Variable shortener.
+        if not corr_list:
+            return []
 
-        total_time = 0
-        count = 0
-
-        #import pdb; pdb.set_trace()
+        pairs = []
         if corr_list[0]['Creator'] != self.user:
             # First correspondence is from OIT (aka replying to a ticket created by user).
-            created_time = self.parse_time(self.histories[0]['Created'])
-            first_corr_time = self.parse_time(corr_list[0]['Created'])
-            total_time += self.get_time_difference(created_time, first_corr_time)
-            count = 1
-
-        for i in range(len(corr_list)):
-            if corr_list[i]['Creator'] == self.user:
-                if i+1 != len(corr_list) and corr_list[i+1]['Creator'] != self.user:
-                    corr_list[i]
-                    total_time += self.get_time_difference(self.parse_time(corr_list[i]['Created']),
-                                                           self.parse_time(corr_list[i+1]['Created']))
-                    count += 1
-
-        if count == 0:
+            pairs.append((self.histories[0]['Created'], corr_list[0]['Created']))
+
+        for i in range(len(corr_list) - 1):
+            if corr_list[i]['Creator'] == self.user and corr_list[i+1]['Creator'] != self.user:
+                pairs.append((corr_list[i]['Created'], corr_list[i+1]['Created']))
+        return pairs
+
+
+    def get_response_time(self):
+        """
+        Return the average response time of the ticket in seconds.
+        Return None if ticket has no correspondence from non-users.
+        See response_time.response_times() to do this for many tickets at once.
+        """
+        pairs = self.response_pairs()
+        if not pairs:
             return None
 
-        return total_time / count
+        total_time = 0
+        for start, end in pairs:
+            total_time += self.get_time_difference(self.parse_time(start), self.parse_time(end))
+        return total_time / len(pairs)
 
 
     def get_time_difference(self, startTime, endTime):
         """
-        Returns the difference between two datetimes in seconds.
-        Ignores weekends. Weekends is Saturday and Sunday, aka 48 hours worth of seconds.
-        """
-        sec_in_day = 86400
-        #import pdb; pdb.set_trace()
-        if startTime.weekday() in [5, 6]:
-            # If time is weekend, use Monday instead.
-            # This does assume that replies will never be made during the weekend.
-            startTime = startTime + timedelta(days=7-startTime.weekday())
-            startTime = startTime.replace(hour=0, minute=0, second=0, microsecond=0)
-        if endTime.weekday() in [5,6]:
-            endTime = endTime + timedelta(days=7-endTime.weekday())
-            endTime = endTime.replace(hour=0, minute=0, second=0, microsecond=0)
-        time_delta = endTime - startTime
-        ret = time_delta.days * sec_in_day + time_delta.seconds
-        if endTime.weekday() < startTime.weekday():
-            ret -= sec_in_day * 2
-        if time_delta.days / 7 > 0:
-            ret -= sec_in_day * int(time_delta.days/7) * 2
-        return ret
+        Returns the working time between two datetimes in seconds.
+        Weekends, holidays and the hours nobody is staffed don't count, see business_calendar.
+        """
+        return business_calendar.default.working_time(int(startTime.timestamp()), int(endTime.timestamp()))
 
 
     def parse_time(self, time):
@@ -150,9 +160,7 @@ class Ticket:
         time (str): The time string that is given by RT. RT gives UTC time, so it needs to be converted.
         Return a datetime in the PST timezone.
         """
-        time = time.strip()
-        time = datetime.strptime(time, "%Y-%m-%d %H:%M:%S").replace(tzinfo=pytz.timezone('UTC'))
-        return time.astimezone(pytz.timezone('US/Pacific'))
+        return business_calendar.parse_time(time)
 
 
 if __name__ == '__main__':
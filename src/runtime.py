@@ -0,0 +1,157 @@
+import asyncio
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from listener import Listener
+from outbox import Outbox
+import metrics
+
+
+class OutgoingClient:
+    """
+    Stands in for the Slack client that is given to the listeners.
+    Sent messages are queued in the runtime's Outbox and sent from the event loop, so handlers running on
+    worker threads don't wait on Slack. Everything else is passed through to the real client.
+    """
+    def __init__(self, client, runtime):
+        self.client = client
+        self.runtime = runtime
+
+    def rtm_send_message(self, channel, message, *args):
+        self.runtime.send_soon(channel, message)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class Runtime:
+    """
+    Runs the bot on an asyncio event loop. Reading RTM events, running handlers and sending messages are separate tasks:
+    - Events are read from Slack in a background thread and queued per channel.
+    - Each channel's messages are handled in order, on a thread pool of at most max_concurrent handlers,
+      so a slow command only holds up its own channel.
+    - on_loop listeners are run every loop_interval seconds.
+    - Messages sent by handlers are queued and sent by the loop, split, merged and paced by an Outbox.
+    """
+
+    def __init__(self, client, parse_event, max_concurrent=4, poll_interval=0.05, loop_interval=0.3):
+        """
+        client (SlackClient): Connected Slack client.
+        parse_event (function): Turns an RTM event into a Context, or None if it isn't a message to handle.
+        """
+        self.slack = client
+        self.client = OutgoingClient(client, self)  # Give this to the listeners.
+        self.parse_event = parse_event
+        self.max_concurrent = max_concurrent
+        self.poll_interval = poll_interval
+        self.loop_interval = loop_interval
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        self.channels = {}  # {channel: asyncio.Queue of (ctx, time received)}, only while the channel has work.
+        self.loop = None
+        self.outbox = Outbox()
+        self.outgoing = None  # asyncio.Event set when a message is put in the outbox.
+        self.semaphore = None
+        self.slow_start = 1.0  # Seconds between receiving an event and handling it before it gets logged.
+
+
+    def run(self):
+        """ Run the bot until it is stopped. """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.main())
+
+
+    def send_soon(self, channel, message):
+        """ Queue a message to be sent. Can be called from any thread. """
+        self.loop.call_soon_threadsafe(self.queue_message, channel, message)
+
+
+    def queue_message(self, channel, message):
+        self.outbox.put(channel, message)
+        self.outgoing.set()
+
+
+    async def main(self):
+        self.outgoing = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        Listener.update("on_ready")
+        await asyncio.gather(self.read_events(), self.tick(), self.send_messages())
+
+
+    async def read_events(self):
+        while True:
+            events = await self.loop.run_in_executor(None, self.slack.rtm_read)
+            if not events:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            received = time.time()
+            metrics.inc("bot_events_total", len(events))
+            for event in events:
+                ctx = self.parse_event(event)
+                if ctx is not None:
+                    self.dispatch(ctx, received)
+
+
+    def dispatch(self, ctx, received):
+        """ Queue the message on its channel, starting a worker for the channel if there isn't one. """
+        queue = self.channels.get(ctx.channel)
+        if queue is None:
+            queue = self.channels[ctx.channel] = asyncio.Queue()
+            asyncio.ensure_future(self.channel_worker(ctx.channel, queue))
+        queue.put_nowait((ctx, received))
+
+
+    async def channel_worker(self, channel, queue):
+        """ Handle a channel's messages in the order they came in. Stops when the channel has nothing left. """
+        while not queue.empty():
+            ctx, received = queue.get_nowait()
+            async with self.semaphore:
+                lag = time.time() - received
+                metrics.observe("bot_event_wait_seconds", lag)
+                if lag > self.slow_start:
+                    print("Message in {} waited {:.2f}s to be handled".format(channel, lag))
+                await self.loop.run_in_executor(self.executor, self.handle, ctx)
+        del self.channels[channel]
+
+
+    def handle(self, ctx):
+        try:
+            Listener.update("on_message", ctx)
+        except:
+            traceback.print_exc()
+
+
+    async def tick(self):
+        while True:
+            try:
+                Listener.update("on_loop")
+            except:
+                traceback.print_exc()
+            slept = time.time()
+            await asyncio.sleep(self.loop_interval)
+            # How late the loop woke up, a busy or blocked event loop shows here first.
+            metrics.observe("bot_loop_lag_seconds", max(0.0, metrics.since(slept) - self.loop_interval))
+
+
+    async def send_messages(self):
+        """ Send what the outbox allows, then sleep until it allows more or a new message comes in. """
+        while True:
+            now = time.time()
+            item = self.outbox.pop(now)
+            if item is None:
+                self.outgoing.clear()
+                try:
+                    await asyncio.wait_for(self.outgoing.wait(), self.outbox.wait_time(now))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            channel, message = item
+            try:
+                self.slack.rtm_send_message(channel, message)
+                self.outbox.sent(channel, now)
+                metrics.inc("bot_messages_sent_total")
+            except:
+                metrics.inc("bot_send_errors_total")
+                traceback.print_exc()
+                self.outbox.failed(channel, message, now)
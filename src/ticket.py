@@ -1,7 +1,9 @@
 import string
-from rt import *
+from rt import RT, RT_Stat
 from listener import Listener
 import traceback
+import os
+import threading
 import pytz
 from datetime import datetime
 
@@ -10,11 +12,18 @@ class Ticket:
     def __init__(self, client):
         self.client = client
         Listener.register(self.on_ready, "on_ready")
-        Listener.register(self.on_message, "on_message")
         Listener.register(self.on_loop, "on_loop")
-        self.rt_stat = RT_Stat()
+        Listener.register(self.on_error, "on_error")
+        Listener.register_pattern(self.link_command, "#[0-9]")
+        Listener.register_command(self.response_handler, ["!response"])
+        Listener.register_command(self.update_handler, ["!update"])
+        Listener.register_command(self.last_updated_handler, ["!last_updated"])
+        Listener.register_command(self.untagged_handler, ["!untagged"])
+        Listener.register_command(self.touch_handler, ['!touch', '!touches', '!tt'])
+        self.rt_stat = RT_Stat(processes=os.cpu_count() or 1)
         self.ticket_url = "https://support.oit.pdx.edu/Ticket/Display.html?id="
         self.update_thread = None
+        self.update_lock = threading.Lock()  # update_thread is set from handler threads and read by on_loop.
         self.current_day = 0  # To detect day change
         self.updated_today = 0  # To check if the bot have updated today.
 
@@ -27,93 +36,133 @@ class Ticket:
         pass
 
     def on_loop(self):
-        if not self.updated_today:
-            self.updated_today = 1
-            self.update_thread = RT.update_cache()
-            
+        with self.update_lock:
+            if not self.updated_today:
+                self.updated_today = 1
+                # Keep reporting an update someone already started, update_cache() gives None then.
+                self.update_thread = RT.update_cache() or self.update_thread
+
+            if self.update_thread:
+                self.report_update_progress()
+
         current_time = datetime.now(pytz.timezone('US/Pacific') )
         if current_time.weekday() != self.current_day:
             self.current_day = current_time.weekday()
 
-        if self.update_thread and not self.update_thread.is_alive():
+    def report_update_progress(self):
+        """
+        Drain the update thread's progress reports. Call with update_lock held.
+        If a channel is bundled with the thread, the reports are sent to the channel.
+        """
+        channel = getattr(self.update_thread, 'channel', None)
+        # Checked before draining so a report pushed right before the thread exits isn't lost.
+        alive = self.update_thread.is_alive()
+        while not self.update_thread.result.empty():
+            report = self.update_thread.result.get()
+            if report["finished"]:
+                self.update_thread = None
+                if channel:
+                    if report["failure"]:
+                        response = "Update stopped on an error after fetching {}/{} tickets: {}\nThe rest will be picked up by the next update.\n".format(
+                            report["done"], report["total"], report["failure"])
+                    else:
+                        response = "Done updating {} tickets ({:.2f} tickets/sec)\n".format(report["total"], report["rate"])
+                    if report["errors"]:
+                        response += "There were {} errors found. Check the error log to see what they were.".format(report["errors"])
+                    self.send_message(channel, response)
+                print("Update stopped!" if report["failure"] else "Done updating!")
+                return
+            if channel:
+                self.send_message(channel, "Updated {done}/{total} tickets ({rate:.2f} tickets/sec)".format(**report))
+
+        if not alive:
+            # Thread died without finishing.
             self.update_thread = None
-            if hasattr(self.update_thread, 'channel'):
-                # If a channel is bundled, then send a message to the channel.
-                error_count = self.update_thread.result.get()
-                response = "Done updating\n"
-                if error_count:
-                    response += "There were {} errors found. Check the error log to see what they were.".format(error_count)
-                self.send_message(self.update_thread.channel, response)
-            print("Done updating!")
 
         
 
-    def on_message(self, ctx):
-        try:  # Don't exit the bot when an error happens.
-            if ctx.command and ctx.command[0] != '!':
-            # Ticket linker.
-                try:
-                    ticket_list = self.parse_message_for_tickets(ctx.message)
-                    response = ""
-                    for ticket_number in ticket_list:
-                        ticket = RT.get_ticket(ticket_number)
-                        response += self.ticket_url + str(ticket_number) + "\n" + \
-                                    "Subject: " + ticket.content['Subject'] + "\n"
-                    self.send_message(ctx.channel, response)
-                except:
-                    traceback.print_exc()
-
-            if ctx.command in ["!response"]:
-                if len(ctx.args) == 1:
-                    try:
-                        days_ago = int(ctx.args[0])
-                    except ValueError:
-                        traceback.print_exc()
-                        self.client.rtm_send_message(channel_id, "Invalid value. Please enter amount of days.")
-                    self.response_command(ctx.channel, days_ago)
-
-
-
-            if ctx.command in ["!update"]:
-                pre_response = "Updating {} tickets since {}".format(RT.get_amount_to_update(), RT.get_last_updated())
-                self.send_message(ctx.channel, pre_response)
-                self.update_thread = RT.update_cache()
-                self.update_thread.channel = ctx.channel
-
-            if ctx.command in ["!last_updated"]:
-                response = "There are {} tickets to update since {}".format(RT.get_amount_to_update(), RT.get_last_updated())
-                self.send_message(ctx.channel, response)
-
-
-            if ctx.command in ["!untagged"]:
-                untagged = self.rt_stat.untag_blame()
-                if not untagged:
-                    response = ":smile: Woo! All the tickets are tagged! :smile:"
-                    self.send_message(ctx.channel, response)
-                    return
-                response = ":angry: Hey! You guys didn't tag your tickets!!! :angry:\n"
-                for person in untagged.keys():
-                    response += "{}: {}.\n".format(person, ", ".join(map(str, untagged[person])))
-                #response = response[:-2] + ".\n"  # Replace the last comma with a period.
-                response += "(This is only for fun, it's not designed to place blame on anyone!)"
-                self.send_message(ctx.channel, response)
-
-
-            if ctx.command in ['!touch', '!touches', '!tt']:
-                if len(ctx.args) >= 1:
-                    username = ctx.args[0]
-                    try:
-                        days_ago = int(ctx.args[1])
-                    except ValueError:
-                        traceback.print_exc()
-                        self.client.rtm_send_message(channel_id, "Invalid value. Please enter amount of days.")
-                    self.ticket_touch_command(ctx.channel, days_ago, username)
-                    
-                
-                
-        except:
-            traceback.print_exc()
-            self.send_message(ctx.channel, "An error has occured in the bot... :thinking_face:")
+    def on_error(self, error, *args):
+        """ Don't exit the bot when an error happens, let the channel know instead. """
+        if args and getattr(args[0], 'channel', None):
+            self.send_message(args[0].channel, "An error has occured in the bot... :thinking_face:")
+
+
+    def link_command(self, ctx):
+        """ Ticket linker. """
+        ticket_list = self.parse_message_for_tickets(ctx.message)
+        if not ticket_list:
+            return
+        # Handlers run off the event loop, so the lookup can wait on RT here.
+        found = RT.get_tickets_properties(ticket_list)
+        response = ""
+        for ticket_number in ticket_list:
+            if ticket_number in found:
+                response += self.ticket_url + str(ticket_number) + "\n" + \
+                            "Subject: " + found[ticket_number]['Subject'] + "\n"
+        if response:
+            self.send_message(ctx.channel, response)
+
+
+    def response_handler(self, ctx):
+        if len(ctx.args) == 1:
+            try:
+                days_ago = int(ctx.args[0])
+            except ValueError:
+                traceback.print_exc()
+                self.send_message(ctx.channel, "Invalid value. Please enter amount of days.")
+                return
+            self.response_command(ctx.channel, days_ago)
+
+
+    def update_handler(self, ctx):
+        if not RT.updating:
+            pre_response = "Updating {} tickets since {}".format(RT.get_amount_to_update(), RT.get_last_updated())
+            self.send_message(ctx.channel, pre_response)
+        with self.update_lock:
+            update_thread = RT.update_cache()
+            if update_thread is None:
+                # Already updating, report the running update here instead.
+                self.send_message(ctx.channel, "An update is already running.")
+                if self.update_thread:
+                    self.update_thread.channel = ctx.channel
+                return
+            self.update_thread = update_thread
+            self.update_thread.channel = ctx.channel
+
+
+    def last_updated_handler(self, ctx):
+        response = "There are {} tickets to update since {}".format(RT.get_amount_to_update(), RT.get_last_updated())
+        self.send_message(ctx.channel, response)
+
+
+    def untagged_handler(self, ctx):
+        if ctx.args and ctx.args[0] == "rebuild":
+            count = RT.rebuild_untagged()
+            self.send_message(ctx.channel, "Rebuilt the untagged tickets from the cache, found {}.".format(count))
+            return
+        untagged = self.rt_stat.untag_blame()
+        if not untagged:
+            response = ":smile: Woo! All the tickets are tagged! :smile:"
+            self.send_message(ctx.channel, response)
+            return
+        response = ":angry: Hey! You guys didn't tag your tickets!!! :angry:\n"
+        for person in untagged.keys():
+            response += "{}: {}.\n".format(person, ", ".join(map(str, untagged[person])))
+        #response = response[:-2] + ".\n"  # Replace the last comma with a period.
+        response += "(This is only for fun, it's not designed to place blame on anyone!)"
+        self.send_message(ctx.channel, response)
+
+
+    def touch_handler(self, ctx):
+        if len(ctx.args) >= 1:
+            username = ctx.args[0]
+            try:
+                days_ago = int(ctx.args[1])
+            except ValueError:
+                traceback.print_exc()
+                self.send_message(ctx.channel, "Invalid value. Please enter amount of days.")
+                return
+            self.ticket_touch_command(ctx.channel, days_ago, username)
 
 
     def response_command(self, channel_id, days_ago):